@@ -0,0 +1,548 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import tempfile
+import time
+import xml.etree.ElementTree as ElementTree
+import pyodbc
+import illiad_manager
+import im_import
+
+"""
+This module benchmarks the ILLiad user import against synthetic user
+exports, no ILLiad database access is required.
+
+The following benchmarks exist:
+
+getuser:
+    - Users/second parsed by illiad_manager.getuser compared to
+      illiad_manager.UserExtractor, both parsers must produce
+      identical User entries
+pipeline:
+    - Seconds spent in each phase of an import, run against synthetic
+      export files and a local SQLite3 stand-in for the ILLiad Users,
+      UserNotifications and Transactions tables, churn controls the
+      share of Users added, updated and removed
+check-diff:
+    - Runs the SQL and the single pass Python diff engine on the same
+      synthetic import, both must generate identical ILL_* tables
+
+Results are printed and written to a JSON report, bench_report.json
+by default.
+
+Example Usage:
+```
+  python3 benchmark.py --users 50000 > bench_output.txt
+  python3 benchmark.py --pipeline --users 100000 --churn 0.05
+  python3 benchmark.py --check-diff --users 100000 --churn 0.1
+  python3 benchmark.py --generate data --users 1000000
+```
+"""
+
+# ILLiad tables of the stand-in, the columns used by illiad_manager
+STAND_IN_SCHEMA = """
+create table Users (UserName TEXT PRIMARY KEY, LastName TEXT,
+    FirstName TEXT, SSN TEXT, Status TEXT, EMailAddress TEXT, Phone TEXT,
+    Department TEXT, Address TEXT, City TEXT, State TEXT, Zip TEXT,
+    Site TEXT, LastChangedDate TEXT, NVTGC TEXT, Cleared TEXT, Web TEXT,
+    NotificationMethod TEXT, AuthType TEXT);
+create table UserNotifications (UserName TEXT, ActivityType TEXT,
+    NotificationType TEXT,
+    PRIMARY KEY (UserName, ActivityType, NotificationType));
+create table Transactions (TransactionNumber INTEGER PRIMARY KEY,
+    UserName TEXT);
+create index Transactions_UserName on Transactions (UserName);
+"""
+
+# Share of the employee export among the synthetic Users
+EMPLOYEE_SHARE = 0.25
+
+# Phases timed by bench_pipeline, in run order
+PIPELINE_PHASES = ("parse", "update_tables", "gen_user_adds",
+                   "gen_user_updates", "gen_user_removals", "add_users",
+                   "update_users", "remove_users")
+
+
+def synthetic_user(i, rng):
+    """Build the XML text of a single synthetic <user> entry
+    Entries vary in the number of addresses, emails, phones and
+    identifiers so every branch of the parsers is exercised
+
+    Parameters:
+    i: Sequence number of the User, used to derive unique identifiers
+    rng: random.Random object used to vary the entry
+
+    Returns:
+    A string object containing a <user> element
+    """
+    parts = ["<user>",
+             "<primary_id>user%07d</primary_id>" % i,
+             "<first_name>First%d</first_name>" % i]
+    if rng.random() < 0.5:
+        parts.append("<middle_name>M</middle_name>")
+    parts.append("<last_name>Last%d</last_name>" % i)
+    parts.append("<user_group>%s</user_group>" %
+                 rng.choice(["STUDENT", "FACULTY", "STAFF"]))
+    parts.append("<contact_info><addresses>")
+    for j in range(rng.randint(0, 3)):
+        parts.append(
+            '<address preferred="%s"><line1>%d Synthetic Street</line1>'
+            "<city>City%d</city><state_province>OK</state_province>"
+            "<postal_code>%05d</postal_code><address_types>"
+            "<address_type>%s</address_type></address_types></address>"
+            % ("true" if j == 0 else "false", i, j, i % 100000,
+               rng.choice(["home", "work", "school"])))
+    parts.append("</addresses><emails>")
+    for j in range(rng.randint(0, 2)):
+        parts.append('<email preferred="%s"><email_address>user%d.%d@example'
+                     ".edu</email_address></email>"
+                     % ("true" if j == 0 else "false", i, j))
+    parts.append("</emails><phones>")
+    for j in range(rng.randint(0, 2)):
+        parts.append('<phone preferred="%s"><phone_number>555%07d'
+                     "</phone_number></phone>"
+                     % ("true" if j == 0 else "false", i))
+    parts.append("</phones></contact_info><user_identifiers>")
+    for id_type in rng.sample(["BARCODE", "UNIV_ID", "OTHER"],
+                              rng.randint(1, 2)):
+        parts.append("<user_identifier><id_type>%s</id_type>"
+                     "<value>%s%d</value></user_identifier>"
+                     % (id_type, id_type[0], i))
+    parts.append("</user_identifiers><user_statistics>")
+    for cat, values in (("CAT1", 3), ("CAT2", 40), ("CAT3", 60)):
+        parts.append("<user_statistic><statistic_category>%s:%s%d"
+                     "</statistic_category></user_statistic>"
+                     % (cat, cat, rng.randrange(values)))
+    parts.append("</user_statistics></user>")
+    return "".join(parts)
+
+
+def synthetic_categories():
+    """Build departmental and major/degree category dictionaries
+    matching the categories used by synthetic_user
+
+    Returns:
+    cat2dict, cat3dict: Two dictionaries as built from cat2s and cat3s
+    """
+    cat2dict = dict(("CAT2%d" % i, "Department %d" % i) for i in range(40))
+    cat3dict = dict(("CAT3%d" % i, "Major %d" % i) for i in range(60))
+    return cat2dict, cat3dict
+
+
+def _getdate():
+    """GETDATE() of the stand-in, formatted like ILLiad datetimes
+    """
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+class StandInCursor:
+    """A pyodbc like cursor over the SQLite3 stand-in,
+    SQLite3 integrity errors are raised as pyodbc.IntegrityError
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.fast_executemany = False
+
+    def execute(self, sql, *params):
+        if len(params) == 1 and isinstance(params[0], (list, tuple)):
+            params = params[0]
+        try:
+            self.cursor.execute(sql, params)
+        except sqlite3.IntegrityError as e:
+            raise pyodbc.IntegrityError(str(e))
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        try:
+            self.cursor.executemany(sql, seq_of_params)
+        except sqlite3.IntegrityError as e:
+            raise pyodbc.IntegrityError(str(e))
+        return self
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        return self.cursor.fetchmany(size or self.cursor.arraysize)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self):
+        self.cursor.close()
+
+
+class StandInConnection:
+    """A pyodbc like connection to the SQLite3 stand-in for ILLiad
+    """
+
+    def __init__(self, path, autocommit=True):
+        self.cnxn = sqlite3.connect(path, timeout=60,
+                                    check_same_thread=False,
+                                    isolation_level=None)
+        self.cnxn.create_function("GETDATE", 0, _getdate)
+        self.autocommit = autocommit
+
+    @property
+    def autocommit(self):
+        return self.cnxn.isolation_level is None
+
+    @autocommit.setter
+    def autocommit(self, value):
+        if value and self.cnxn.in_transaction:
+            self.cnxn.commit()
+        self.cnxn.isolation_level = None if value else ""
+
+    def cursor(self):
+        return StandInCursor(self.cnxn.cursor())
+
+    def commit(self):
+        self.cnxn.commit()
+
+    def rollback(self):
+        self.cnxn.rollback()
+
+    def close(self):
+        self.cnxn.close()
+
+
+def _ill_row(User):
+    """Convert a formatted User entry into an ILLiad Users row
+    """
+    row = dict(zip(illiad_manager.USER_COLUMNS, User))
+    return (row["alt_id"], row["last_name"], row["first_name"],
+            row["user_id"], row["user_profile"], row["email1"],
+            row["phone1"], row["department"], row["main_street"][:39],
+            row["main_city"][:29], row["main_state"][:2], row["main_zip"],
+            row["user_cat1"])
+
+
+def generate_sources(directory, users, churn=0.05, seed=1):
+    """Write synthetic lib_emp.txt, lib_stu.txt, cat2s and cat3s files
+    and an ILLiad stand-in, illiad.db, holding the Users of the previous
+    import. The churn share of the Users is split evenly between Users
+    missing from ILLiad, Users changed since the previous import and
+    ILLiad Users missing from the exports, half of the latter have a
+    transaction history.
+
+    Parameters:
+    directory: Directory the files are written to
+    users: Number of synthetic Users in the exports
+    churn: Share of the Users added, updated and removed by an import
+    seed: Seed for the synthetic data
+
+    Returns:
+    counts: A dictionary with the number of Users per kind of change
+    """
+    rng = random.Random(seed)
+    cat2dict, cat3dict = synthetic_categories()
+    for name, categories in (("cat2s", cat2dict), ("cat3s", cat3dict)):
+        with open(os.path.join(directory, name), "w") as catfile:
+            for code, value in sorted(categories.items()):
+                catfile.write("synthetic|%s|%s|%s|\n" % (name, code, value))
+
+    extract = illiad_manager.UserExtractor(cat2dict, cat3dict)
+    per_kind = int(users * churn / 3)
+    churned = random.Random(seed + 1).sample(range(users), 2 * per_kind)
+    added = set(churned[:per_kind])
+    updated = set(churned[per_kind:])
+    ill_rows = []
+    employees = int(users * EMPLOYEE_SHARE)
+    for name, first, last in (("lib_emp.txt", 0, employees),
+                              ("lib_stu.txt", employees, users)):
+        with open(os.path.join(directory, name), "w") as export:
+            export.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                         '<users total_record_count="%d">\n'
+                         % (last - first))
+            for i in range(first, last):
+                entry = synthetic_user(i, rng)
+                export.write(entry + "\n")
+                if i in added:
+                    # Missing from ILLiad, added by the import
+                    continue
+                row = _ill_row(extract(ElementTree.fromstring(entry)))
+                if i in updated:
+                    # Changed since the previous import
+                    row = row[:5] + ("old." + row[5],) + row[6:]
+                ill_rows.append(row)
+            export.write("</users>\n")
+
+    path = os.path.join(directory, "illiad.db")
+    if os.path.exists(path):
+        os.remove(path)
+    cnxn = sqlite3.connect(path)
+    cnxn.executescript(STAND_IN_SCHEMA)
+    # Gone from the exports, removed by the import
+    for i in range(per_kind):
+        ill_rows.append(("gone%07d" % i, "Gone%d" % i, "User", "G%d" % i,
+                         "STUDENT", "", "", "", "", "", "", "", "STUDENT"))
+    now = _getdate()
+    cnxn.executemany(
+        """insert into Users values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+        ?, 'ILL', 'Yes', 'Yes', 'Electronic', 'RemoteAuth')""",
+        [row + (now,) for row in ill_rows])
+    cnxn.executemany(
+        """insert into UserNotifications values (?, ?, 'Email')""",
+        [(row[0], activity) for row in ill_rows
+         for activity in illiad_manager.NOTIFICATION_ACTIVITIES])
+    cnxn.executemany(
+        """insert into Transactions (UserName) values (?)""",
+        [("gone%07d" % i,) for i in range(0, per_kind, 2)])
+    cnxn.commit()
+    cnxn.close()
+    return {"adds": per_kind, "updates": per_kind, "removals": per_kind,
+            "protected": len(range(0, per_kind, 2))}
+
+
+def bench_pipeline(users, churn=0.05, seed=1, directory=None, **options):
+    """Time every phase of an import against synthetic exports and the
+    ILLiad stand-in, run in directory or a temporary directory
+
+    Parameters:
+    users: Number of synthetic Users in the exports
+    churn: Share of the Users added, updated and removed by the import
+    seed: Seed for the synthetic data
+    directory: Optional directory kept after the run
+    options: Keyword arguments passed on to illiad_manager
+
+    Returns:
+    results: A dictionary containing the generated change counts, the
+        seconds per phase in PIPELINE_PHASES, the resulting row counts
+        and the run record of illiad_manager
+    """
+    with tempfile.TemporaryDirectory() as scratch:
+        directory = directory or scratch
+        start = time.perf_counter()
+        generated = generate_sources(directory, users, churn, seed)
+        generate = time.perf_counter() - start
+
+        ill_path = os.path.join(directory, "illiad.db")
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            im = illiad_manager.illiad_manager(
+                sqlite_path=os.path.join(directory, "sqlite.db"),
+                illiad_connect=lambda: StandInConnection(ill_path),
+                **options)
+            cat2dict, cat3dict = im_import.load_categories()
+            args = im_import.parse_args([])
+            phases = (
+                ("parse", lambda: im_import.parse_users(
+                    args, im, cat2dict, cat3dict)),
+                ("update_tables", lambda: im.update_tables(user_list)),
+                ("gen_user_adds", im.gen_user_adds),
+                ("gen_user_updates", im.gen_user_updates),
+                ("gen_user_removals", im.gen_user_removals),
+                ("add_users", im.add_users),
+                ("update_users", im.update_users),
+                ("remove_users", im.remove_users),
+            )
+            seconds = {}
+            for name, phase in phases:
+                start = time.perf_counter()
+                result = phase()
+                seconds[name] = time.perf_counter() - start
+                if name == "parse":
+                    user_list = result
+            rows = {}
+            for table in ("USERS_NEW", "USERS_OLD", "ILL_ADD", "ILL_UPDATE",
+                          "ILL_REMOVE"):
+                rows[table] = im.sqlite3_cursor.execute(
+                    "select count(*) from " + table).fetchone()[0]
+            metrics = im.metrics.record("SUCCESS")
+            im.close_cnxn()
+        finally:
+            os.chdir(cwd)
+
+    return {"users": users, "churn": churn, "seed": seed,
+            "generate_seconds": generate, "generated": generated,
+            "seconds": seconds, "rows": rows, "metrics": metrics}
+
+
+def _ill_tables(im):
+    """Return the sorted rows of each ILL_* table
+    """
+    return dict((table, sorted(map(repr, im.sqlite3_cursor.execute(
+        "select * from " + table)))) for table in
+        ("ILL_ADD", "ILL_REMOVE", "ILL_UPDATE"))
+
+
+def check_diff(users, churn=0.05, seed=1):
+    """Generate the ILL_* tables of a synthetic import with the SQL
+    queries and with gen_user_changes and compare them
+
+    Parameters:
+    users: Number of synthetic Users in the exports
+    churn: Share of the Users added, updated and removed by the import
+    seed: Seed for the synthetic data
+
+    Returns:
+    results: A dictionary containing the seconds per diff engine
+        and the number of rows per ILL_* table
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        generate_sources(directory, users, churn, seed)
+        ill_path = os.path.join(directory, "illiad.db")
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            im = illiad_manager.illiad_manager(
+                sqlite_path=os.path.join(directory, "sqlite.db"),
+                illiad_connect=lambda: StandInConnection(ill_path))
+            cat2dict, cat3dict = im_import.load_categories()
+            im.update_tables(im_import.parse_users(
+                im_import.parse_args([]), im, cat2dict, cat3dict))
+
+            start = time.perf_counter()
+            im.gen_user_adds()
+            im.gen_user_removals()
+            im.gen_user_updates()
+            sql_seconds = time.perf_counter() - start
+            expected = _ill_tables(im)
+
+            start = time.perf_counter()
+            im.gen_user_changes()
+            python_seconds = time.perf_counter() - start
+            generated = _ill_tables(im)
+            im.close_cnxn()
+        finally:
+            os.chdir(cwd)
+
+    for table, rows in expected.items():
+        if generated[table] != rows:
+            raise AssertionError("gen_user_changes differs from the SQL "
+                                 "diff in " + table)
+    return {"seconds": {"sql": sql_seconds, "python": python_seconds},
+            "rows": dict((table, len(rows))
+                         for table, rows in expected.items())}
+
+
+def bench_getuser(users, repeat=3, seed=1):
+    """Compare getuser with UserExtractor over synthetic User entries
+
+    Parameters:
+    users: Number of synthetic Users to parse
+    repeat: Number of timed passes, the fastest pass is reported
+    seed: Seed for the synthetic data
+
+    Returns:
+    results: A dictionary mapping parser name to users/second
+    """
+    rng = random.Random(seed)
+    root = ElementTree.fromstring(
+        "<users>" + "".join(synthetic_user(i, rng) for i in range(users)) +
+        "</users>")
+    elements = root.findall("user")
+    cat2dict, cat3dict = synthetic_categories()
+    # getuser does not touch the database connections, skip __init__
+    im = illiad_manager.illiad_manager.__new__(illiad_manager.illiad_manager)
+    extract = illiad_manager.UserExtractor(cat2dict, cat3dict)
+
+    parsers = [
+        ("getuser", lambda User: im.getuser(User, cat2dict, cat3dict)),
+        ("UserExtractor", extract),
+    ]
+    outputs = {}
+    results = {}
+    for name, parse in parsers:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            parsed = [parse(User) for User in elements]
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        outputs[name] = parsed
+        results[name] = users / best
+
+    extracted = [list(User.as_row()) for User in outputs["UserExtractor"]]
+    if outputs["getuser"] != extracted:
+        raise AssertionError("UserExtractor output differs from getuser")
+    return results
+
+
+def main(argv=None):
+    """Run the benchmarks and print their results
+
+    Parameters:
+    argv: List of command line arguments, defaults to sys.argv
+
+    Returns:
+    None
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ILLiad user import")
+    parser.add_argument("--users", type=int, default=20000,
+                        help="number of synthetic Users")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of timed passes per benchmark")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="seed for the synthetic data")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="time every import phase against the ILLiad "
+                        "stand-in instead of the parsers")
+    parser.add_argument("--check-diff", action="store_true",
+                        help="compare the SQL and Python diff engines")
+    parser.add_argument("--churn", type=float, default=0.05,
+                        help="share of Users added, updated and removed")
+    parser.add_argument("--generate", metavar="DIR",
+                        help="only write synthetic files and the ILLiad "
+                        "stand-in to DIR")
+    parser.add_argument("--report", default="bench_report.json",
+                        help="path of the JSON report")
+    args = parser.parse_args(argv)
+
+    if args.generate:
+        os.makedirs(args.generate, exist_ok=True)
+        counts = generate_sources(args.generate, args.users, args.churn,
+                                  args.seed)
+        print("generated " + str(args.users) + " synthetic Users in " +
+              args.generate + ": " + json.dumps(counts, sort_keys=True))
+        return
+
+    report = {"created": datetime.datetime.now().isoformat(),
+              "python": platform.python_version(),
+              "sqlite": sqlite3.sqlite_version}
+    if args.check_diff:
+        print("check-diff: " + str(args.users) + " synthetic Users, churn " +
+              str(args.churn))
+        results = check_diff(args.users, args.churn, args.seed)
+        for name, seconds in results["seconds"].items():
+            print("\t%-18s %10.3f seconds" % (name, seconds))
+        print("\tidentical ILL_* tables: " + json.dumps(results["rows"],
+                                                        sort_keys=True))
+        report["check_diff"] = results
+    elif args.pipeline:
+        print("pipeline: " + str(args.users) + " synthetic Users, churn " +
+              str(args.churn))
+        results = bench_pipeline(args.users, args.churn, args.seed)
+        for name in PIPELINE_PHASES:
+            print("\t%-18s %10.3f seconds" % (name, results["seconds"][name]))
+        report["pipeline"] = results
+    else:
+        print("getuser: " + str(args.users) + " synthetic Users")
+        results = bench_getuser(args.users, args.repeat, args.seed)
+        for name, rate in results.items():
+            print("\t%-14s %10.0f users/second" % (name, rate))
+        print("\tspeedup        %10.2fx" %
+              (results["UserExtractor"] / results["getuser"]))
+        report["getuser"] = {"users": args.users, "users_per_second": results}
+
+    with open(args.report, "w") as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,20 @@
+import collections
+import concurrent.futures
+import datetime
+import hashlib
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import queue
+import re
 import sqlite3
+import threading
+import zlib
+import xml.etree.ElementTree as ElementTree
 import pyodbc
+import run_metrics
 import secrets
 
 
@@ -14,6 +29,17 @@ finder:
     - XML Lookup tool
 get_user:
     - Process XML entry and return formatted User entry
+iter_users:
+    - Stream a XML export and yield formatted User entries one at a time
+UserExtractor:
+    - Single pass replacement for get_user used by the import
+UserRecord:
+    - Compact parsed User entry, the userdata column is built on demand
+Canonicalizer:
+    - Apply the ILLiad column rules once, as rows enter USERS_NEW
+      and USERS_OLD
+parse_parallel:
+    - Parse XML exports across a pool of worker processes
 gen_user_adds:
     - Compares USERS_OLD with USERS_NEW to generate table
       containing User additions
@@ -23,10 +49,28 @@ gen_user_removals:
 gen_user_updates:
     - Compares USERS_NEW with USERS_OLD to generate table
       containing User updates
+gen_user_changes:
+    - Single pass Python alternative to the three gen_user_* queries
+update_signature / group_updates:
+    - Select the fields written by an update from its changed_fields
+migrate_schema:
+    - Creates the local SQLite3 tables, upgrading older databases
+update_digests:
+    - Computes the digests compared by gen_user_updates
 update_tables:
     - Takes a list containing parsed User data to be passed into SQLite3,
       this will shift USERS_NEW to USERS_OLD and generate a fresh USERS_NEW
       from parsed User data
+load_new_users:
+    - Load parsed User data into USERS_NEW without refreshing USERS_OLD
+plan_changes:
+    - Summarize the pending changes without writing ILL_* or using ODBC
+refresh_snapshot:
+    - Refreshes USERS_OLD from ILLiad, fully or incrementally
+load_pipelined:
+    - Refresh USERS_OLD and load USERS_NEW at the same time
+begin_load / end_load:
+    - Reload a SQLite3 table in place or through a swapped staging table
 add_users:
     - Add users in ILLiad database from SQLite3 User addition table
 update_users()
@@ -34,17 +78,820 @@ update_users()
 
 remove_users()
     - Remove users in ILLiad database from SQLite3 User remove table
+source_fingerprint / save_fingerprints:
+    - Detect source files unchanged since the previous successful run
+cache_users / cache_digest / cached_users:
+    - Keep the parsed Users of each source file for later runs
+record_run:
+    - Keep the run record built by run_metrics in RUN_HISTORY
+apply_chunks()
+    - Apply ILL_* rows to ILLiad in committed, resumable chunks
+apply_pipelined()
+    - Apply several ILL_* tables to ILLiad at the same time
+ConnectionPool:
+    - A fixed set of ILLiad connections shared by concurrent apply workers
+transaction_holders()
+    - Find which ILLiad users have a transaction history
 
 """
 
+# Number of rows handed to a single executemany call when loading SQLite3
+BATCH_SIZE = 10000
+
+# Number of rows fetched per fetchmany call when streaming a result set
+# from ILLiad or SQLite3 into executemany or apply_chunks
+FETCH_SIZE = 5000
+
+# Number of ILL_* rows applied to ILLiad per transaction
+APPLY_BATCH_SIZE = 1000
+
+# Number of partitions applied to ILLiad concurrently, each partition is
+# applied in order on one pooled connection at a time
+APPLY_WORKERS = 1
+
+# Ways update_users applies a chunk of updates to ILLiad:
+#   executemany: one parameterized UPDATE per User
+#   staged: bulk load into a session temp table, then one UPDATE ... FROM
+UPDATE_BACKENDS = ("executemany", "staged")
+
+# Ways the ILL_* tables are generated from USERS_OLD and USERS_NEW:
+#   sql: gen_user_adds, gen_user_removals and gen_user_updates
+#   python: a single pass of gen_user_changes
+DIFF_ENGINES = ("sql", "python")
+
+# Number of chunks a pipelined stage may hold before its producer waits,
+# bounds the memory of update_tables and apply_pipelined
+PIPELINE_QUEUE_SIZE = 4
+
+# Number of UserNames listed per change set by plan_changes
+PLAN_SAMPLE_SIZE = 20
+
+# Number of parameters in a single ILLiad IN (...) lookup,
+# SQL Server accepts at most 2100 parameters per statement
+IN_LIST_SIZE = 1000
+
+# Number of <user> entries handed to a parse worker process at once
+PARSE_CHUNK_SIZE = 2000
+
+# Email notifications enabled for every User added to ILLiad
+NOTIFICATION_ACTIVITIES = ("ClearedUser", "PasswordReset", "RequestPickup",
+                           "RequestShipped", "RequestElectronicDelivery",
+                           "RequestOverdue", "RequestCancelled",
+                           "RequestOther")
+NOTIFICATION_INSERT = """INSERT INTO UserNotifications
+                         (UserName, ActivityType, NotificationType)
+                         VALUES (?, ?, 'Email')"""
+
+# Columns compared by gen_user_updates, in digest order
+DIGEST_COLUMNS = ("alt_id", "last_name", "first_name", "user_id",
+                  "user_profile", "email1", "phone1", "department",
+                  "main_street", "main_city", "main_state", "main_zip",
+                  "user_cat1")
+
+# ILLiad column rules applied by Canonicalizer when rows enter USERS_NEW
+# and USERS_OLD: NULL is stored as "" except in the KEY_COLUMNS, which
+# keep their NULLs so they never match, COLUMN_LENGTHS are the number of
+# characters ILLiad keeps for truncated columns and a main_zip longer
+# than ZIP_LENGTH is stored as ZIP_ERROR
+KEY_COLUMNS = ("alt_id", "user_id")
+COLUMN_LENGTHS = {"main_street": 39, "main_city": 29, "main_state": 2}
+ZIP_LENGTH = 10
+ZIP_ERROR = "-ERR-"
+
+# ILLiad Users columns written by update_users, in the order of the
+# DIGEST_COLUMNS after alt_id they are written from
+UPDATE_FIELDS = ("LastName", "FirstName", "SSN", "Status", "EMailAddress",
+                 "Phone", "Department", "Address", "City", "State", "Zip",
+                 "Site")
+
+# Local SQLite3 database, relative to the working directory
+SQLITE_DB = "sqlite.db"
+
+# SQLite3 connection profiles: pragmas applied to the on-disk database,
+# the memory profile additionally stages all non persistent tables in an
+# in-memory database and attaches the on-disk database as "disk"
+SQLITE_PROFILES = {
+    "default": (),
+    "wal": (("journal_mode", "WAL"), ("synchronous", "NORMAL")),
+    "fast": (("journal_mode", "WAL"), ("synchronous", "NORMAL"),
+             ("cache_size", "-131072"), ("temp_store", "MEMORY")),
+    "memory": (("journal_mode", "WAL"), ("synchronous", "NORMAL"),
+               ("cache_size", "-131072"), ("temp_store", "MEMORY")),
+}
+
+# Connection wide pragmas, all others are set per database
+_CONNECTION_PRAGMAS = ("temp_store",)
+
+# Columns of USERS_OLD, USERS_NEW and the ILL_* tables, in table order
+USER_COLUMNS = ("user_id", "alt_id", "user_name_full", "first_name",
+                "middle_name", "last_name", "user_profile", "user_cat1",
+                "user_cat2", "major", "user_cat3", "department", "phone1",
+                "main_street", "main_city", "main_state", "main_zip",
+                "email1", "userdata")
+
+
+def _user_columns(key=None):
+    """Column definitions of a User table, key becomes its primary key
+    """
+    return ", ".join(column + " TEXT" + (" PRIMARY KEY" if column == key
+                                         else "")
+                     for column in USER_COLUMNS)
+
+
+def _changed_fields():
+    """SQL expression of the changed_fields bitmask of ILL_UPDATE, bit i
+    is set when UPDATE_FIELDS[i] differs between the User in USERS_NEW f
+    and USERS_OLD o, compared as by user_digest. Both tables hold
+    canonical values, only the KEY_COLUMNS can be NULL
+    """
+    terms = []
+    for bit, column in enumerate(DIGEST_COLUMNS[1:]):
+        values = [table + "." + column for table in ("f", "o")]
+        if column in KEY_COLUMNS:
+            values = ["ifnull(" + value + ", '')" for value in values]
+        terms.append("((" + " != ".join(values) + ") << " + str(bit) + ")")
+    return " | ".join(terms)
+
+
+# Version of the local SQLite3 schema, stored in PRAGMA user_version,
+# version 0 is the original untyped schema,
+# version 2 adds SNAPSHOT_STATE, version 3 adds APPLY_LEDGER,
+# version 4 adds SOURCE_FINGERPRINTS and USERS_CACHE,
+# version 5 adds RUN_HISTORY, version 6 adds ILL_UPDATE.changed_fields,
+# version 7 stores canonical values, see Canonicalizer,
+# version 8 adds USERS_CACHE_SOURCES
+SCHEMA_VERSION = 8
+
+# Local SQLite3 tables: (name, column definitions, table options)
+SCHEMA = (
+    ("USERS_OLD", _user_columns("alt_id"), ""),
+    ("USERS_NEW", _user_columns(), ""),
+    ("ILL_ADD", _user_columns(), ""),
+    ("ILL_REMOVE", _user_columns(), ""),
+    ("ILL_UPDATE", _user_columns() + ", changed_fields INTEGER", ""),
+    ("DIGEST_OLD", "alt_id TEXT PRIMARY KEY, digest BLOB NOT NULL",
+     "WITHOUT ROWID"),
+    ("DIGEST_NEW", "row_id INTEGER PRIMARY KEY, alt_id TEXT, "
+     "digest BLOB NOT NULL", ""),
+    ("SNAPSHOT_STATE", "name TEXT PRIMARY KEY, value TEXT", ""),
+    ("APPLY_LEDGER", "phase TEXT, row_id INTEGER, "
+     "PRIMARY KEY (phase, row_id)", "WITHOUT ROWID"),
+    ("SOURCE_FINGERPRINTS", "path TEXT PRIMARY KEY, size INTEGER, "
+     "mtime INTEGER, digest BLOB, rows_digest BLOB", ""),
+    ("USERS_CACHE", "source TEXT, " + _user_columns(), ""),
+    ("USERS_CACHE_SOURCES", "source TEXT PRIMARY KEY, digest BLOB NOT NULL",
+     "WITHOUT ROWID"),
+    ("RUN_HISTORY", "run_id INTEGER PRIMARY KEY, started TEXT, status TEXT, "
+     "wall_seconds REAL, record TEXT", ""),
+)
+
+# Tables kept in the on-disk database by the memory profile,
+# every other table is staged in memory and rebuilt on each run
+PERSISTENT_TABLES = ("USERS_OLD", "DIGEST_OLD", "SNAPSHOT_STATE",
+                     "ILL_ADD", "ILL_REMOVE", "ILL_UPDATE", "APPLY_LEDGER",
+                     "SOURCE_FINGERPRINTS", "USERS_CACHE",
+                     "USERS_CACHE_SOURCES", "RUN_HISTORY")
+
+# Format of the LastChangedDate high-water mark kept in SNAPSHOT_STATE
+MARK_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# Columns pulled from the ILLiad Users table into USERS_OLD, in the order
+# of the USERS_OLD columns they are stored in
+ILL_USER_SELECT = """SELECT UserName, LastName,
+                FirstName, SSN, Status, EMailAddress, Phone, Department,
+                Address, City, State, Zip, Site from Users"""
+USERS_OLD_INSERT = """(alt_id, last_name, first_name, user_id,
+            user_profile, email1, phone1, department,
+            main_street, main_city, main_state,
+            main_zip, user_cat1)
+            values(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+# Queries comparing USERS_NEW with USERS_OLD, shared by the gen_user_*
+# functions filling the ILL_* tables and by plan_changes.
+# Users in USERS_NEW whose user_id is not in USERS_OLD,
+# the anti-join is resolved through the USERS_OLD_user_id index
+ADD_SELECT = """select f.* from USERS_NEW f
+               where not exists (select 1 from USERS_OLD o
+                                 where o.user_id = f.user_id)"""
+# Users in USERS_OLD whose user_id is not in USERS_NEW, resolved through
+# the USERS_NEW_user_id index, Users without a user_id are never removed
+REMOVE_SELECT = """select f.* from USERS_OLD f
+               where f.user_id is not null
+               and not exists (select 1 from USERS_NEW n
+                               where n.user_id = f.user_id)"""
+# Users whose digest differs from the digest of the same alt_id in
+# USERS_OLD, in the column order of UPDATE_COLUMNS
+UPDATE_SELECT = """select f.alt_id, f.last_name, f.first_name,
+            f.user_id, f.user_profile, f.email1, f.phone1, f.department,
+            f.main_street, f.main_city, f.main_state, f.main_zip, f.user_cat1,
+            """ + _changed_fields() + """
+                from DIGEST_NEW d
+                join DIGEST_OLD a on a.alt_id = d.alt_id
+                join USERS_NEW f on f.rowid = d.row_id
+                join USERS_OLD o on o.alt_id = d.alt_id
+                where d.digest != a.digest"""
+UPDATE_COLUMNS = """alt_id, last_name, first_name,
+            user_id, user_profile, email1, phone1, department, main_street,
+            main_city, main_state, main_zip, user_cat1, changed_fields"""
+# Users updated more than once are updated in full, in order, so the
+# last row wins as a whole
+FULL_UPDATES = """update ILL_UPDATE set changed_fields = null
+               where alt_id in (select alt_id from ILL_UPDATE
+                                group by alt_id having count(*) > 1)"""
+
+# Secondary indexes: (name, table, columns)
+INDEXES = (
+    ("USERS_OLD_user_id", "USERS_OLD", "user_id"),
+    ("USERS_NEW_user_id", "USERS_NEW", "user_id"),
+    ("USERS_CACHE_source", "USERS_CACHE", "source"),
+)
+
+_USER_START = re.compile(rb"<user[\s/>]")
+_USER_END = b"</user>"
+_TAG_NAME = re.compile(rb"<([A-Za-z_][\w.:-]*)")
+_XML_COMMENT = re.compile(rb"<!--.*?-->", re.S)
+
+
+def chunked(iterable, size):
+    """Split an iterable into lists containing at most size entries
+
+    Parameters:
+    iterable: Any iterable, consumed lazily
+    size: Maximum number of entries per chunk
+
+    Returns:
+    A generator yielding lists of entries
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def fetch_chunks(cursor, size=FETCH_SIZE):
+    """Stream the result set of an executed cursor in lists of rows
+
+    Parameters:
+    cursor: pyodbc or SQLite3 cursor with a pending result set
+    size: Maximum number of rows per list, also set as cursor.arraysize
+
+    Returns:
+    A generator yielding lists of at most size rows
+    """
+    cursor.arraysize = size
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield rows
+
+
+def user_digest(*values):
+    """Compute the fixed-size digest of a User entry
+    registered with SQLite3 as user_digest()
+
+    Parameters:
+    values: Canonical values of the DIGEST_COLUMNS of a User entry,
+        in order, NULL KEY_COLUMNS are treated as ""
+
+    Returns:
+    A 16 byte bytes object
+    """
+    return hashlib.blake2b("\x1f".join(
+        "" if value is None else str(value)
+        for value in values).encode("utf-8"), digest_size=16).digest()
+
+
+def file_fingerprint(path, previous=None):
+    """Compute the size, modification time and content digest of a file,
+    the content is only read when size or mtime differ from previous
+
+    Parameters:
+    path: Path of the file
+    previous: Optional (size, mtime, digest, ...) of an earlier fingerprint
+
+    Returns:
+    size, mtime, digest: The size in bytes, the mtime in nanoseconds and
+        a 16 byte bytes object
+    """
+    stat = os.stat(path)
+    if (previous is not None and previous[0] == stat.st_size and
+            previous[1] == stat.st_mtime_ns):
+        return stat.st_size, stat.st_mtime_ns, previous[2]
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as source:
+        for block in iter(lambda: source.read(1 << 20), b""):
+            digest.update(block)
+    return stat.st_size, stat.st_mtime_ns, digest.digest()
+
+
+def _digest_columns():
+    """Comma separated DIGEST_COLUMNS, the arguments of user_digest()
+    """
+    return ", ".join(DIGEST_COLUMNS)
+
+
+def _format_mark(value):
+    """Convert a LastChangedDate high-water mark to text
+    """
+    if isinstance(value, datetime.datetime):
+        return value.strftime(MARK_FORMAT)
+    return str(value)
+
+
+def _parse_mark(text):
+    """Convert a high-water mark stored by _format_mark back to a datetime
+    """
+    try:
+        return datetime.datetime.strptime(text, MARK_FORMAT)
+    except ValueError:
+        return text
+
+
+def _first_text(elem, tag):
+    """Return the text of the first child of elem named tag
+    Mirrors illiad_manager.finder for a single level path
+
+    Parameters:
+    elem: Element object whose children are searched
+    tag: Tag name of the child to lookup
+
+    Returns:
+    A string object containing the text value of the child,
+        contains "" if the lookup fails
+    """
+    for child in elem:
+        if child.tag == tag:
+            return child.text
+    return ""
+
+
+class UserRecord(collections.namedtuple("UserRecord", USER_COLUMNS[:-1])):
+    """A parsed User entry holding the USER_COLUMNS except userdata,
+    which joins every other field with "|" and is only built when the
+    entry is converted to SQLite3 parameters by as_row
+    """
+
+    __slots__ = ()
+
+    @property
+    def userdata(self):
+        return "|".join(self)
+
+    def as_row(self):
+        """Return the 19 USER_COLUMNS values as a tuple
+        """
+        return tuple(self) + (self.userdata,)
+
+
+class Canonicalizer:
+    """Apply the ILLiad column rules to rows entering USERS_NEW or
+    USERS_OLD, so every later comparison and apply query reads the
+    stored values as they are
+
+    NULL values become "" except in the KEY_COLUMNS, the COLUMN_LENGTHS
+    are truncated and a main_zip longer than ZIP_LENGTH becomes
+    ZIP_ERROR. Canonical rows are returned unchanged.
+
+    Parameters:
+    columns: Names of the columns of the rows, in order
+    """
+
+    def __init__(self, columns):
+        self.columns = tuple(columns)
+        self.nullable = [column in KEY_COLUMNS for column in self.columns]
+        self.lengths = [(i, COLUMN_LENGTHS[column])
+                        for i, column in enumerate(self.columns)
+                        if column in COLUMN_LENGTHS]
+        self.zips = [i for i, column in enumerate(self.columns)
+                     if column == "main_zip"]
+
+    def __call__(self, row):
+        """Convert a row into its canonical values
+
+        Parameters:
+        row: A sequence of values of the columns
+
+        Returns:
+        row: A list containing the canonical values
+        """
+        row = ["" if value is None and not nullable else value
+               for value, nullable in zip(row, self.nullable)]
+        for i, length in self.lengths:
+            row[i] = row[i][:length]
+        for i in self.zips:
+            if len(row[i]) > ZIP_LENGTH:
+                row[i] = ZIP_ERROR
+        return row
+
+
+# Canonical values of the USER_COLUMNS before userdata
+_canonical_user = Canonicalizer(USER_COLUMNS[:-1])
+
+# Canonical values of the ILLiad Users columns stored in USERS_OLD
+_canonical_ill_user = Canonicalizer(DIGEST_COLUMNS)
+
+
+def user_row(User):
+    """Convert a User entry, a UserRecord or a list or tuple of all
+    USER_COLUMNS, into canonical SQLite3 parameters, userdata is
+    rebuilt from the canonical values
+
+    Parameters:
+    User: A formatted User entry
+
+    Returns:
+    A list of the 19 USER_COLUMNS values
+    """
+    row = _canonical_user(User[:len(USER_COLUMNS) - 1])
+    row.append("|".join(row))
+    return row
+
+
+def update_signature(changed_fields):
+    """Convert a changed_fields bitmask of ILL_UPDATE into the indexes of
+    the UPDATE_FIELDS to write
+
+    Parameters:
+    changed_fields: An integer, None when every field is written
+
+    Returns:
+    A tuple of indexes into UPDATE_FIELDS
+    """
+    if changed_fields is None:
+        return tuple(range(len(UPDATE_FIELDS)))
+    return tuple(i for i in range(len(UPDATE_FIELDS))
+                 if changed_fields >> i & 1)
+
+
+def group_updates(user_updates):
+    """Group ILLiad Users update rows by the fields they change, in the
+    order each signature first appears
+
+    Parameters:
+    user_updates: List of rows, changed_fields first, then the values of
+        the UPDATE_FIELDS and the UserName last
+
+    Returns:
+    A list of (signature, rows) pairs, signature as returned by
+    update_signature and rows without changed_fields
+    """
+    groups = collections.OrderedDict()
+    for i in user_updates:
+        groups.setdefault(i[0], []).append(i[1:])
+    return [(update_signature(changed_fields), rows)
+            for changed_fields, rows in groups.items()]
+
+
+class UserExtractor:
+    """Parse XML User entries into formatted User entries in a single pass
+
+    This produces the same fields as illiad_manager.getuser, but walks
+    each <user> subtree once instead of issuing a path lookup per field,
+    and returns a UserRecord instead of a list.
+    Category dictionaries are bound once, the object is then called
+    with each <user> element.
+
+    Parameters:
+    cat2dict: A dictionary containing departmental categories
+    cat3dict: A dictionary containing major/degree categories
+    """
+
+    # Direct children of <user> copied verbatim, first occurrence wins
+    TOP_FIELDS = ("primary_id", "first_name", "middle_name", "last_name",
+                  "user_group")
+
+    def __init__(self, cat2dict={}, cat3dict={}):
+        self.cat2dict = cat2dict
+        self.cat3dict = cat3dict
+
+    def __call__(self, User):
+        """Parse a XML User entry and output a UserRecord
+        containing formatted User entries
+
+        Parameters:
+        User: Element object of a single <user> entry
+
+        Returns:
+        User: A UserRecord containing parsed users fields
+        """
+        top = {}
+        address = None
+        email_elem = None
+        phone_elem = None
+        id_type = ""
+        id_val = ""
+        id_type_found = False
+        id_val_found = False
+        cats = {}
+        for child in User:
+            tag = child.tag
+            if tag in self.TOP_FIELDS:
+                if tag not in top:
+                    top[tag] = child.text
+            elif tag == "contact_info":
+                for section in child:
+                    if section.tag == "addresses":
+                        # Every address overwrites the previous one
+                        for i in section:
+                            address = i
+                    elif section.tag == "emails":
+                        for i in section:
+                            if i.get("preferred") == "true":
+                                email_elem = i
+                    elif section.tag == "phones":
+                        for i in section:
+                            if i.get("preferred") == "true":
+                                phone_elem = i
+            elif tag == "user_identifiers":
+                for ident in child:
+                    if ident.tag != "user_identifier":
+                        continue
+                    for i in ident:
+                        if i.tag == "id_type" and not id_type_found:
+                            id_type = i.text
+                            id_type_found = True
+                        elif i.tag == "value" and not id_val_found:
+                            id_val = i.text
+                            id_val_found = True
+            elif tag == "user_statistics":
+                for stat in child:
+                    if stat.tag != "user_statistic":
+                        continue
+                    tmparr = (_first_text(stat, "statistic_category")
+                              or "").split(":")
+                    if len(tmparr) > 1:
+                        cats[tmparr[0]] = tmparr[1]
+
+        ouNetID = top.get("primary_id", "")
+        firstName = top.get("first_name", "") or ""
+        middleName = top.get("middle_name", "") or ""
+        lastName = top.get("last_name", "") or ""
+        userGroup = top.get("user_group", "")
+        line1 = city = state = postalCode = ""
+        if address is not None:
+            line1 = _first_text(address, "line1")
+            city = _first_text(address, "city")
+            state = _first_text(address, "state_province")
+            postalCode = _first_text(address, "postal_code")
+        email = ""
+        if email_elem is not None:
+            email = _first_text(email_elem, "email_address")
+        phone = ""
+        if phone_elem is not None:
+            phone = _first_text(phone_elem, "phone_number")
+        barcode = id_val if id_type == "BARCODE" else ""
+        usercat2 = cats.get("CAT2")
+        usercat3 = cats.get("CAT3")
+        new_user = [
+            barcode,
+            ouNetID,
+            " ".join([firstName, middleName, lastName]),
+            firstName,
+            middleName,
+            lastName,
+            userGroup,
+            cats.get("CAT1"),
+            usercat2,
+            self.cat2dict.get(usercat2),
+            usercat3,
+            self.cat3dict.get(usercat3),
+            phone,
+            line1,
+            city,
+            state,
+            postalCode,
+            email,
+        ]
+
+        for i, j in enumerate(new_user):
+            if j is None:
+                new_user[i] = ""
+
+        return UserRecord._make(new_user)
+
+
+def split_user_chunks(path, chunk_size=PARSE_CHUNK_SIZE):
+    """Split a XML export into standalone XML documents,
+    each containing at most chunk_size <user> entries
+
+    The export is scanned for <user> boundaries without being parsed,
+    every chunk is wrapped in the prolog and root element of the export
+    so it keeps the original encoding and namespaces.
+
+    Parameters:
+    path: Path of the XML document to split
+    chunk_size: Maximum number of <user> entries per chunk
+
+    Returns:
+    A generator yielding bytes objects containing XML documents
+    """
+    with open(path, "rb") as xmlfile:
+        try:
+            data = mmap.mmap(xmlfile.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped and contain no Users
+            return
+        with data:
+            first = _USER_START.search(data)
+            # Skip <user> tags inside comments before the first User
+            while first is not None:
+                comment = data.rfind(b"<!--", 0, first.start())
+                if comment == -1 or data.find(b"-->", comment,
+                                              first.start()) != -1:
+                    break
+                closed = data.find(b"-->", first.start())
+                first = (None if closed == -1 else
+                         _USER_START.search(data, closed))
+            if first is None:
+                return
+            header = data[:first.start()]
+            # Only the root element is left open by the header, elements
+            # before the first User are closed within it
+            root = _TAG_NAME.search(_XML_COMMENT.sub(b"", header)).group(1)
+            footer = b"</" + root + b">"
+            start = first.start()
+            while True:
+                end = start
+                for _ in range(chunk_size):
+                    pos = data.find(_USER_END, end)
+                    if pos == -1:
+                        break
+                    end = pos + len(_USER_END)
+                if end == start:
+                    return
+                yield header + data[start:end] + footer
+                start = end
+
+
+_parse_extract = None
+
+
+def _init_parse_worker(cat2dict, cat3dict):
+    """Bind the category dictionaries once in each parse worker process
+    """
+    global _parse_extract
+    _parse_extract = UserExtractor(cat2dict, cat3dict)
+
+
+def _parse_chunk(chunk):
+    """Parse a chunk produced by split_user_chunks in a worker process
+
+    Parameters:
+    chunk: bytes object containing a XML document
+
+    Returns:
+    A list containing formatted User entries
+    """
+    root = ElementTree.fromstring(chunk)
+    return [_parse_extract(User) for User in root.findall("user")]
+
+
+def parse_parallel(paths, cat2dict={}, cat3dict={}, workers=None,
+                   chunk_size=PARSE_CHUNK_SIZE):
+    """Parse XML exports across a pool of worker processes
+
+    Every export is split into chunks of <user> entries and all chunks
+    of all exports are parsed concurrently. Results are yielded in the
+    order of paths and of the entries within each export, matching a
+    serial parse.
+    The worker processes are started by this call, before the caller
+    starts any thread of its own, and at most two chunks per worker are
+    read ahead of the Users yielded, so memory stays bounded.
+
+    Parameters:
+    paths: List of paths of the XML documents to parse
+    cat2dict: A dictionary containing departmental categories
+    cat3dict: A dictionary containing major/degree categories
+    workers: Number of worker processes, defaults to the CPU count
+    chunk_size: Maximum number of <user> entries per chunk
+
+    Returns:
+    A generator yielding UserRecords containing parsed users fields
+    """
+    workers = workers or os.cpu_count() or 1
+    pool = multiprocessing.Pool(workers, _init_parse_worker,
+                                (cat2dict, cat3dict))
+    return _parse_pooled(pool, paths, chunk_size, 2 * workers)
+
+
+def _parse_pooled(pool, paths, chunk_size, window):
+    """Yield the Users of paths parsed by pool, keeping at most window
+    chunks submitted to pool at once, the pool is closed once done
+    """
+    chunks = itertools.chain.from_iterable(
+        split_user_chunks(path, chunk_size) for path in paths)
+    pending = collections.deque()
+    try:
+        for chunk in chunks:
+            pending.append(pool.apply_async(_parse_chunk, (chunk,)))
+            if len(pending) >= window:
+                for User in pending.popleft().get():
+                    yield User
+        while pending:
+            for User in pending.popleft().get():
+                yield User
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+class ConnectionPool:
+    """A fixed size pool of ILLiad connections
+
+    Connections are opened on first use, at most size connections exist
+    and acquire blocks until one is released. pyodbc connections must not
+    be used by two threads at once, a connection belongs to the thread
+    that acquired it until it is released.
+    """
+
+    def __init__(self, size, connect=None):
+        """Object defintions:
+              size:
+                - Maximum number of open connections
+              connect:
+                - Function returning a new autocommit ILLiad connection
+        """
+
+        self.size = size
+        self.connect = connect or (
+            lambda: pyodbc.connect(secrets.illiad_cnxn, autocommit=True))
+        self.idle = queue.LifoQueue()
+        self.opened = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a connection out of the pool, opening a new one while
+           fewer than size connections exist
+
+        Parameters:
+        None
+
+        Returns:
+        cnxn: An ILLiad connection in autocommit mode
+        """
+
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if len(self.opened) < self.size:
+                cnxn = self.connect()
+                self.opened.append(cnxn)
+                return cnxn
+        return self.idle.get()
+
+    def release(self, cnxn):
+        """Return a connection acquired from the pool
+
+        Parameters:
+        cnxn: The connection returned by acquire
+
+        Returns:
+        None
+        """
+
+        self.idle.put(cnxn)
+
+    def close(self):
+        """Close every connection opened by the pool
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+
+        with self.lock:
+            for cnxn in self.opened:
+                cnxn.close()
+            self.opened = []
+        self.idle = queue.LifoQueue()
+
 
 class illiad_manager:
-    def __init__(self):
+    def __init__(self, sqlite_profile="default", sqlite_path=SQLITE_DB,
+                 apply_batch_size=APPLY_BATCH_SIZE,
+                 update_backend="executemany", apply_workers=APPLY_WORKERS,
+                 apply_connections=None, illiad_connect=None,
+                 fetch_size=FETCH_SIZE):
         """Object defintions:
               illcnxn:
-                - ILLiad Database Connection
+                - ILLiad Database Connection, opened on first use
               sqlite3cnxn:
-                - Local SQLite3 Database Connection
+                - Local SQLite3 Database Connection, opened with one of
+                  the SQLITE_PROFILES
+              persistent_schema:
+                - SQLite3 schema holding the PERSISTENT_TABLES,
+                  "disk" for the memory profile and "main" otherwise
               ill_cursor:
                 - Cursor object for ILLiad Database,
                   performs operations using illcnxn
@@ -53,228 +900,1004 @@ class illiad_manager:
               sqlite3_cursor:
                 - Cursor object for local SQLite3 Database,
                   performs operations using sqlite3cnxn
+              apply_batch_size:
+                - Number of ILL_* rows applied to ILLiad per transaction
+              update_backend:
+                - One of the UPDATE_BACKENDS used by update_users
+              apply_workers:
+                - Number of partitions of each ILL_* table applied to
+                  ILLiad concurrently, 1 applies every row on illcnxn
+              ill_pool:
+                - ConnectionPool of at most apply_connections ILLiad
+                  connections, apply_workers when not given, used by
+                  the apply workers
+              illiad_connect:
+                - Function returning a new autocommit ILLiad connection,
+                  defaults to pyodbc with secrets.illiad_cnxn
+              fetch_size:
+                - Number of rows fetched at once when streaming result sets
+              metrics:
+                - run_metrics.RunMetrics object, both cursors count the
+                  work they do into it
+        """
+
+        if update_backend not in UPDATE_BACKENDS:
+            raise ValueError("Unknown update backend: " + update_backend)
+        self.apply_batch_size = apply_batch_size
+        self.fetch_size = fetch_size
+        self.update_backend = update_backend
+        self.apply_workers = max(1, apply_workers)
+        self.illiad_connect = illiad_connect or (
+            lambda: pyodbc.connect(secrets.illiad_cnxn, autocommit=True))
+        self.ill_pool = ConnectionPool(apply_connections or self.apply_workers,
+                                       self.illiad_connect)
+
+        # ILLiad is connected on first use of illcnxn or ill_cursor
+        self._illcnxn = None
+        self._ill_cursor = None
+        if sqlite_profile == "memory":
+            self.sqlite3cnxn = sqlite3.connect(":memory:")
+            self.sqlite3cnxn.execute("""attach database ? as disk""",
+                                     (sqlite_path,))
+            self.persistent_schema = "disk"
+        else:
+            self.sqlite3cnxn = sqlite3.connect(sqlite_path)
+            self.persistent_schema = "main"
+        self.metrics = run_metrics.RunMetrics()
+        self.sqlite3_cursor = self.metrics.cursor(self.sqlite3cnxn.cursor(),
+                                                  "sqlite")
+        for pragma, value in SQLITE_PROFILES[sqlite_profile]:
+            if pragma in _CONNECTION_PRAGMAS:
+                self.sqlite3_cursor.execute(
+                    "pragma " + pragma + " = " + value)
+            else:
+                self.sqlite3_cursor.execute(
+                    "pragma " + self.persistent_schema + "." + pragma +
+                    " = " + value)
+        self.sqlite3cnxn.create_function("user_digest", len(DIGEST_COLUMNS),
+                                         user_digest)
+        self.migrate_schema()
+
+    @property
+    def illcnxn(self):
+        """ILLiad Database Connection, opened on first use
+        """
+        if self._illcnxn is None:
+            self._illcnxn = self.illiad_connect()
+        return self._illcnxn
+
+    @property
+    def ill_cursor(self):
+        """Cursor object for ILLiad Database, opened on first use
+        """
+        if self._ill_cursor is None:
+            self._ill_cursor = self.metrics.cursor(self.illcnxn.cursor(),
+                                                   "illiad")
+            self._ill_cursor.fast_executemany = True
+        return self._ill_cursor
+
+    @run_metrics.instrumented
+    def migrate_schema(self):
+        """This function creates the local SQLite3 tables and indexes,
+        upgrading a database created by an older version of this module
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+        version = self.sqlite3_cursor.execute(
+            "pragma " + self.persistent_schema + ".user_version").fetchone()[0]
+        self.sqlite3cnxn.commit()
+        self.sqlite3_cursor.execute("""begin""")
+        try:
+            legacy = []
+            if version < 1:
+                legacy = self.migrate_untyped_tables()
+            if 1 <= version < 6:
+                # Pending updates without a bitmask are applied in full
+                self.sqlite3_cursor.execute(
+                    "alter table " + self.schema_of("ILL_UPDATE") +
+                    ".ILL_UPDATE add column changed_fields INTEGER")
+            for name, columns, options in SCHEMA:
+                self.create_table(name)
+            for name, columns, options in SCHEMA:
+                self.create_indexes(name)
+            for name in legacy:
+                legacy_table = self.persistent_schema + "." + name + "_LEGACY"
+                self.sqlite3_cursor.execute(
+                    "insert or replace into " + self.schema_of(name) + "." +
+                    name + " (" + ", ".join(USER_COLUMNS) + ") select * from " +
+                    legacy_table)
+                self.sqlite3_cursor.execute("drop table " + legacy_table)
+            if version < 7:
+                self.migrate_canonical_values()
+            self.sqlite3_cursor.execute(
+                "pragma " + self.persistent_schema + ".user_version = " +
+                str(SCHEMA_VERSION))
+        except BaseException:
+            self.sqlite3cnxn.rollback()
+            raise
+        self.sqlite3cnxn.commit()
+        if version < 7:
+            # Digests are derived data, dropped with the untyped schema
+            # and computed from raw values before version 7
+            self.update_digests("USERS_OLD")
+            self.update_digests("USERS_NEW")
+            self.sqlite3cnxn.commit()
+
+    def migrate_untyped_tables(self):
+        """This function moves the tables of the untyped version 0 schema
+        out of the way, their rows are copied back by migrate_schema once
+        the typed tables exist
+
+        Parameters:
+        None
+
+        Returns:
+        legacy: A list containing the names of the moved tables
+        """
+        schema = self.persistent_schema
+        existing = set(i[0] for i in self.sqlite3_cursor.execute(
+            "select name from " + schema + ".sqlite_master " +
+            "where type = 'table'"))
+        legacy = []
+        for name in ("USERS_OLD", "USERS_NEW", "ILL_ADD", "ILL_REMOVE",
+                     "ILL_UPDATE"):
+            if name in existing:
+                print("\tMigrating SQLite3 Table: " + name)
+                self.sqlite3_cursor.execute(
+                    "alter table " + schema + "." + name + " rename to " +
+                    name + "_LEGACY")
+                legacy.append(name)
+        for name in ("DIGEST_OLD", "DIGEST_NEW"):
+            self.sqlite3_cursor.execute(
+                "drop table if exists " + schema + "." + name)
+        # Replaced by the primary key of USERS_OLD
+        self.sqlite3_cursor.execute(
+            "drop index if exists " + schema + ".USERS_OLD_alt_id")
+        return legacy
+
+    def migrate_canonical_values(self):
+        """This function converts the DIGEST_COLUMNS of the rows stored
+        before version 7 into canonical values, see Canonicalizer, the
+        pending ILL_ADD and ILL_UPDATE rows are converted as well since
+        add_users and update_users no longer shape the values they send
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+        columns = ", ".join(DIGEST_COLUMNS)
+        assignments = ", ".join(column + " = ?" for column in DIGEST_COLUMNS)
+        for name in ("USERS_OLD", "USERS_NEW", "ILL_ADD", "ILL_UPDATE"):
+            changed = []
+            for i in self.sqlite3_cursor.execute(
+                    "select rowid, " + columns + " from " + name).fetchall():
+                row = _canonical_ill_user(i[1:])
+                if row != list(i[1:]):
+                    changed.append(row + [i[0]])
+            self.sqlite3_cursor.executemany(
+                "update " + name + " set " + assignments +
+                " where rowid = ?", changed)
+
+    def create_table(self, name, table=None):
+        """This function creates a local SQLite3 table if it does not exist
+
+        Parameters:
+        name: Name of a table in SCHEMA
+        table: Name of the table to create with the definition of name,
+            defaults to name
+
+        Returns:
+        None
+        """
+        for schema_name, columns, options in SCHEMA:
+            if schema_name == name:
+                self.sqlite3_cursor.execute(
+                    "create table if not exists " + self.schema_of(name) +
+                    "." + (table or name) + " (" + columns + ") " + options)
+                return
+        raise KeyError(name)
+
+    def create_indexes(self, name):
+        """This function creates the secondary indexes of a local SQLite3
+        table if they do not exist
+
+        Parameters:
+        name: Name of a table in SCHEMA
+
+        Returns:
+        None
+        """
+        for index, table, columns in INDEXES:
+            if table == name:
+                self.sqlite3_cursor.execute(
+                    "create index if not exists " + self.schema_of(name) +
+                    "." + index + " on " + table + " (" + columns + ")")
+
+    def schema_of(self, name):
+        """This function returns the SQLite3 schema a table is kept in
+
+        Parameters:
+        name: Name of a table in SCHEMA
+
+        Returns:
+        A string object, "main" or the persistent_schema
+        """
+        if name in PERSISTENT_TABLES:
+            return self.persistent_schema
+        return "main"
+
+    @run_metrics.instrumented
+    def gen_user_adds(self):
+        """This function creates a table containg entries to be added in ILLiad
+        These entries are calculated by finding entries present in USERS_NEW
+        that are not present in USERS_OLD.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+
+        print('\tClearing SQLite3 Table: ILL_ADD')
+        self.sqlite3_cursor.execute("""delete from ILL_ADD""")
+        self.reset_ledger("add")
+        print('\tGetting Users to be added to ILLiad')
+        # Rows are copied inside SQLite3
+        self.sqlite3_cursor.execute("""insert into ILL_ADD """ + ADD_SELECT)
+        print('\tMarking ' + str(self.sqlite3_cursor.rowcount) +
+              ' Users in SQLite3 to be added to ILLiad')
+        # Committed before anything is applied, so a run failing on its
+        # first chunk can be resumed with the regenerated table
+        self.sqlite3cnxn.commit()
+
+    @run_metrics.instrumented
+    def gen_user_removals(self):
+        """This creates a table containg entries to be removed in ILLiad
+        These entries are calculated by finding entries present in USERS_OLD
+        that are not present in USERS_NEW.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+
+        print('\tClearing SQLite3 Table: ILL_REMOVE')
+        self.sqlite3_cursor.execute("""delete from ILL_REMOVE""")
+        self.reset_ledger("remove")
+        print('\tGetting Users to be Removed from ILLiad')
+        self.sqlite3_cursor.execute(
+            """insert into ILL_REMOVE """ + REMOVE_SELECT)
+        print('\tMarking ' + str(self.sqlite3_cursor.rowcount) +
+              ' Users in SQLite3 to be Removed from ILLiad')
+        self.sqlite3cnxn.commit()
+
+    @run_metrics.instrumented
+    def gen_user_updates(self):
+        """This function creates a table containg metadata updates
+        for existing users in ILLiad
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+
+        print('\tClearing SQLite3 Table: ILL_UPDATE')
+        self.sqlite3_cursor.execute("""delete from ILL_UPDATE""")
+        self.reset_ledger("update")
+        print('\tGetting Users to Updated in ILLiad')
+        # Digests are computed once by update_tables, changed Users are
+        # found by a keyed digest comparison on alt_id
+        self.sqlite3_cursor.execute(
+            """insert into ILL_UPDATE(""" + UPDATE_COLUMNS + """) """ +
+            UPDATE_SELECT)
+        print('\tMarking ' + str(self.sqlite3_cursor.rowcount) +
+              ' Users in SQLite3 to be Updated in ILLiad')
+        self.sqlite3_cursor.execute(FULL_UPDATES)
+        self.sqlite3cnxn.commit()
+
+    @run_metrics.instrumented
+    def gen_user_changes(self, adds=True, removals=True, updates=True):
+        """This function generates ILL_ADD, ILL_REMOVE and ILL_UPDATE in a
+        single pass, producing the same rows as gen_user_adds,
+        gen_user_removals and gen_user_updates, which remain the reference.
+        The keys and digests of USERS_OLD are read once into a set and a
+        dictionary, USERS_NEW is then streamed once and every User is
+        classified. Only the rows of changed Users are copied into the
+        ILL_* tables, looked up by rowid.
+
+        Parameters:
+        adds: Generate ILL_ADD
+        removals: Generate ILL_REMOVE
+        updates: Generate ILL_UPDATE
+
+        Returns:
+        None
+        """
+
+        print('\tReading Keys of SQLite3 Table USERS_OLD')
+        old_keys = self.sqlite3_cursor.execute(
+            """select rowid, user_id from USERS_OLD""").fetchall()
+        old_user_ids = set(i[1] for i in old_keys if i[1] is not None)
+        old_digests = {}
+        if updates:
+            # Computed by update_tables, as compared by gen_user_updates
+            old_digests = dict(self.sqlite3_cursor.execute(
+                """select alt_id, digest from DIGEST_OLD"""))
+
+        user_adds = []
+        user_updates = []
+        new_user_ids = set()
+        print('\tClassifying Users of SQLite3 Table USERS_NEW')
+        for row_id, user_id, alt_id, digest in self.sqlite3_cursor.execute(
+                """select f.rowid, f.user_id, f.alt_id, d.digest
+                   from USERS_NEW f join DIGEST_NEW d on d.row_id = f.rowid
+                   order by f.rowid"""):
+            if user_id is not None:
+                new_user_ids.add(user_id)
+            # NULL user_ids never match, as in the anti-join
+            if adds and (user_id is None or user_id not in old_user_ids):
+                user_adds.append((row_id,))
+            old_digest = old_digests.get(alt_id)
+            if old_digest is not None and digest != old_digest:
+                user_updates.append((row_id,))
+
+        if adds:
+            self.sqlite3_cursor.execute("""delete from ILL_ADD""")
+            self.reset_ledger("add")
+            print('\tMarking ' + str(len(user_adds)) +
+                  ' Users in SQLite3 to be added to ILLiad')
+            self.sqlite3_cursor.executemany(
+                    """insert into ILL_ADD
+                       select * from USERS_NEW where rowid = ?""", user_adds)
+        if removals:
+            user_removals = [(i[0],) for i in old_keys
+                             if i[1] is not None and
+                             i[1] not in new_user_ids]
+            self.sqlite3_cursor.execute("""delete from ILL_REMOVE""")
+            self.reset_ledger("remove")
+            print('\tMarking ' + str(len(user_removals)) +
+                  ' Users in SQLite3 to be Removed from ILLiad')
+            self.sqlite3_cursor.executemany(
+                    """insert into ILL_REMOVE
+                       select * from USERS_OLD where rowid = ?""",
+                    user_removals)
+        if updates:
+            self.sqlite3_cursor.execute("""delete from ILL_UPDATE""")
+            self.reset_ledger("update")
+            print('\tMarking ' + str(len(user_updates)) +
+                  ' Users in SQLite3 to be Updated in ILLiad')
+            self.sqlite3_cursor.executemany(
+                    """insert into ILL_UPDATE(""" + UPDATE_COLUMNS + """)
+                    select f.alt_id, f.last_name, f.first_name,
+                    f.user_id, f.user_profile, f.email1, f.phone1,
+                    f.department, f.main_street, f.main_city, f.main_state,
+                    f.main_zip, f.user_cat1, """ + _changed_fields() + """
+                    from USERS_NEW f join USERS_OLD o on o.alt_id = f.alt_id
+                    where f.rowid = ?""", user_updates)
+            self.sqlite3_cursor.execute(FULL_UPDATES)
+        # Committed before anything is applied, see gen_user_adds
+        self.sqlite3cnxn.commit()
+
+    def plan_changes(self, sample_size=PLAN_SAMPLE_SIZE):
+        """This function sizes the changes the next run would apply,
+        comparing USERS_NEW with the cached USERS_OLD snapshot through the
+        queries used by the gen_user_* functions. Nothing is written to
+        the ILL_* tables and ILLiad is not contacted.
+
+        Parameters:
+        sample_size: Number of UserNames listed per change set
+
+        Returns:
+        plan: A dictionary with the snapshot used, the number of Users
+            per change set, a sample of their UserNames and the number of
+            ILLiad transactions needed to apply them
+        """
+        sets = (("adds", ADD_SELECT +
+                 """ and not exists (select 1 from USERS_OLD o
+                                     where o.alt_id = f.alt_id)"""),
+                ("updates", UPDATE_SELECT),
+                ("removals", REMOVE_SELECT))
+
+        def count(table):
+            return self.sqlite3_cursor.execute(
+                "select count(*) from " + table).fetchone()[0]
+
+        plan = {"snapshot": {"users_last_changed":
+                             self.get_state("users_last_changed"),
+                             "users_old": count("USERS_OLD")},
+                "users_new": count("USERS_NEW"),
+                "apply_batch_size": self.apply_batch_size}
+        for name, query in sets:
+            users = count("(" + query + ")")
+            sample = self.sqlite3_cursor.execute(
+                "select alt_id from (" + query + ") limit ?",
+                (sample_size,)).fetchall()
+            plan[name] = {"users": users,
+                          "transactions": -(-users // self.apply_batch_size),
+                          "sample": [i[0] for i in sample]}
+        return plan
+
+    @run_metrics.instrumented
+    def update_tables(self, user_list, batch_size=BATCH_SIZE, swap=False,
+                      incremental=False, pipelined=False):
+        """This function updates two User management update_tables,
+        USERS_OLD contains the imported users from the previous
+        USERS_NEW contains the new users that are being imported
+
+        Parameters:
+        user_list: List or iterable containing parsed User data to be
+            passed into SQLite3, UserRecords or lists of all USER_COLUMNS,
+            iterables are consumed lazily
+        batch_size: Number of Users inserted into USERS_NEW per executemany
+        swap: Load each table into a fresh staging table and swap it into
+            place once loaded, instead of deleting and reinserting in place
+        incremental: Refresh USERS_OLD with only the ILLiad Users changed
+            since the previous snapshot, see refresh_snapshot
+        pipelined: Download the ILLiad snapshot on a thread of its own
+            while user_list is consumed, see load_pipelined
+
+        Returns:
+        None
+        """
+        if pipelined:
+            self.load_pipelined(user_list, batch_size, swap, incremental)
+            return
+        self.refresh_snapshot(swap, incremental)
+        self.load_new_users(user_list, batch_size, swap)
+
+    def load_pipelined(self, user_list, batch_size=BATCH_SIZE, swap=False,
+                       incremental=False, queue_size=PIPELINE_QUEUE_SIZE):
+        """This function refreshes USERS_OLD and loads USERS_NEW at the
+        same time. The ILLiad snapshot is downloaded by a thread on a
+        pooled connection into a queue of at most queue_size chunks, this
+        thread inserts the parsed Users and stores every downloaded chunk
+        between two batches, so parsing a lazy user_list overlaps with
+        the download. SQLite3 is only used from this thread.
+
+        Parameters:
+        user_list: List or iterable containing parsed User data, see
+            update_tables
+        batch_size: Number of Users inserted into USERS_NEW per executemany
+        swap: Load both tables through swapped staging tables
+        incremental: Refresh incrementally when a previous snapshot exists
+        queue_size: Maximum number of downloaded chunks waiting to be stored
+
+        Returns:
+        None
+        """
+        load = self.begin_snapshot(self.snapshot_mark(incremental), swap)
+        downloaded = queue.Queue(queue_size)
+        failed = threading.Event()
+
+        def download():
+            # The None is queued on every path, also when no connection
+            # could be opened, the error is raised by future.result()
+            cnxn = None
+            try:
+                cnxn = self.ill_pool.acquire()
+                cursor = self.metrics.cursor(cnxn.cursor(), "illiad")
+                for item in self.snapshot_chunks(cursor, load["mark"]):
+                    if failed.is_set():
+                        return
+                    downloaded.put(item)
+            finally:
+                if cnxn is not None:
+                    self.ill_pool.release(cnxn)
+                downloaded.put(None)
+
+        def store_downloaded(block):
+            # Returns False once the download is complete
+            while True:
+                try:
+                    item = downloaded.get(block)
+                except queue.Empty:
+                    return True
+                if item is None:
+                    return False
+                self.store_snapshot(load, *item)
+
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            future = executor.submit(download)
+            running = True
+            try:
+                target = self.begin_load("USERS_NEW", swap)
+                print("\tInserting Users into SQLite3 Table USERS_NEW")
+                inserted = 0
+                for batch in chunked(user_list, batch_size):
+                    self.sqlite3_cursor.executemany(
+                        """insert into """ + target + """ values(?, ?, ?, ?,
+                        ?, ?, ?, ?, ?,?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                        [user_row(User) for User in batch],
+                    )
+                    inserted += len(batch)
+                    if running:
+                        running = store_downloaded(False)
+                        if not running:
+                            # Raises the error of a failed download
+                            future.result()
+                print("\tInserted " + str(inserted) +
+                      " Users into SQLite3 Table USERS_NEW")
+                if running:
+                    running = store_downloaded(True)
+            except BaseException:
+                failed.set()
+                while running:
+                    running = downloaded.get() is not None
+                raise
+        future.result()
+        self.end_snapshot(load)
+        self.end_load("USERS_NEW", swap)
+        self.update_digests("USERS_NEW", swap)
+
+    @run_metrics.instrumented
+    def load_new_users(self, user_list, batch_size=BATCH_SIZE, swap=False):
+        """This function replaces USERS_NEW with the parsed Users and
+        computes their digests, USERS_OLD is left as it is
+
+        Parameters:
+        user_list: List or iterable containing parsed User data, see
+            update_tables
+        batch_size: Number of Users inserted into USERS_NEW per executemany
+        swap: Load USERS_NEW through a swapped staging table
+
+        Returns:
+        None
+        """
+        # # Clear out USERS_NEW and import new users from user_list
+        target = self.begin_load("USERS_NEW", swap)
+        print("\tInserting Users into SQLite3 Table USERS_NEW")
+        inserted = 0
+        for batch in chunked(user_list, batch_size):
+            self.sqlite3_cursor.executemany(
+                        """insert into """ + target + """ values(?, ?, ?, ?,
+                        ?, ?, ?, ?, ?,?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                        [user_row(User) for User in batch],
+                    )
+            inserted += len(batch)
+        print("\tInserted " + str(inserted) +
+              " Users into SQLite3 Table USERS_NEW")
+        self.end_load("USERS_NEW", swap)
+        self.update_digests("USERS_NEW", swap)
+
+    @run_metrics.instrumented
+    def refresh_snapshot(self, swap=False, incremental=False):
+        """This function refreshes USERS_OLD, the local snapshot of the
+        ILLiad Users table, and records the newest LastChangedDate seen
+        as a high-water mark in SNAPSHOT_STATE.
+
+        A full refresh copies every ILLiad User. An incremental refresh
+        copies only the Users changed since the high-water mark and then
+        compares UserNames alone to drop Users deleted from ILLiad. It
+        falls back to a full refresh when there is no previous snapshot.
+
+        Parameters:
+        swap: Load a full refresh through a swapped staging table
+        incremental: Refresh incrementally when a previous snapshot exists
+
+        Returns:
+        None
+        """
+        load = self.begin_snapshot(self.snapshot_mark(incremental), swap)
+        for kind, rows in self.snapshot_chunks(self.ill_cursor, load["mark"]):
+            self.store_snapshot(load, kind, rows)
+        self.end_snapshot(load)
+
+    def snapshot_mark(self, incremental=False):
+        """This function returns the high-water mark an incremental
+        refresh of USERS_OLD starts from
+
+        Parameters:
+        incremental: Refresh incrementally when a previous snapshot exists
+
+        Returns:
+        mark: A string object, None when USERS_OLD needs a full refresh
+        """
+        mark = self.get_state("users_last_changed")
+        if not incremental or mark is None:
+            return None
+        has_snapshot = self.sqlite3_cursor.execute(
+            """select exists (select 1 from USERS_OLD)""").fetchone()[0]
+        if not has_snapshot:
+            return None
+        return mark
+
+    def snapshot_chunks(self, cursor, mark=None):
+        """This function reads the ILLiad side of a snapshot refresh,
+        it does not use SQLite3 so it can run on a thread and an ILLiad
+        connection of its own
+
+        Parameters:
+        cursor: Cursor object for ILLiad Database
+        mark: High-water mark returned by snapshot_mark
+
+        Returns:
+        A generator yielding (kind, rows) pairs, first "mark" with the
+        newest LastChangedDate, then "users" with lists of ILLiad Users
+        rows and, for an incremental refresh, "keys" with lists of the
+        UserNames of every ILLiad User
         """
+        # Taken before the pull, Users changed during the pull are
+        # picked up again by the next incremental refresh
+        yield "mark", cursor.execute(
+            """select max(LastChangedDate) from Users""").fetchone()[0]
+        if mark is None:
+            cursor.execute(ILL_USER_SELECT)
+        else:
+            cursor.execute(ILL_USER_SELECT + " where LastChangedDate >= ?",
+                           _parse_mark(mark))
+        for ill_users in fetch_chunks(cursor, self.fetch_size):
+            yield "users", ill_users
+        if mark is not None:
+            cursor.execute("""select UserName from Users""")
+            for user_names in fetch_chunks(cursor, self.fetch_size):
+                yield "keys", user_names
 
-        self.illcnxn = pyodbc.connect(secrets.illiad_cnxn, autocommit=True)
-        self.sqlite3cnxn = sqlite3.connect("sqlite.db")
-        self.ill_cursor = self.illcnxn.cursor()
-        self.ill_cursor.fast_executemany = True
-        self.sqlite3_cursor = self.sqlite3cnxn.cursor()
+    def begin_snapshot(self, mark=None, swap=False):
+        """This function prepares USERS_OLD for the rows of snapshot_chunks
 
-    def gen_user_adds(self):
-        """This function creates a table containg entries to be added in ILLiad
-        These entries are calculated by finding entries present in USERS_NEW
-        that are not present in USERS_OLD.
+        Parameters:
+        mark: High-water mark returned by snapshot_mark
+        swap: Load a full refresh through a swapped staging table
+
+        Returns:
+        load: A dictionary passed on to store_snapshot and end_snapshot
+        """
+        load = {"mark": mark, "swap": swap, "new_mark": None, "users": 0}
+        if mark is None:
+            load["target"] = self.begin_load("USERS_OLD", swap)
+            print("\tGetting Current ILLiad Users")
+        else:
+            print("\tGetting ILLiad Users changed since " + mark)
+            self.sqlite3_cursor.execute(
+                """create temp table if not exists
+                   ILL_KEYS (UserName TEXT PRIMARY KEY)""")
+            self.sqlite3_cursor.execute("""delete from temp.ILL_KEYS""")
+        return load
+
+    def store_snapshot(self, load, kind, rows):
+        """This function stores one (kind, rows) pair of snapshot_chunks
 
         Parameters:
-        None
+        load: The dictionary returned by begin_snapshot
+        kind: "mark", "users" or "keys"
+        rows: The rows yielded with kind
 
         Returns:
         None
         """
+        if kind == "mark":
+            load["new_mark"] = rows
+        elif kind == "keys":
+            self.sqlite3_cursor.executemany(
+                """insert or ignore into temp.ILL_KEYS values (?)""", rows)
+        elif load["mark"] is None:
+            self.sqlite3_cursor.executemany(
+                "insert into " + load["target"] + " " + USERS_OLD_INSERT,
+                [_canonical_ill_user(i) for i in rows])
+            load["users"] += len(rows)
+        else:
+            self.sqlite3_cursor.executemany(
+                "insert or replace into USERS_OLD " + USERS_OLD_INSERT,
+                [_canonical_ill_user(i) for i in rows])
+            self.update_old_digests([i[0] for i in rows])
+            load["users"] += len(rows)
 
-        self.sqlite3_cursor.execute(
-            """create table if not exists
-                           ILL_ADD (user_id, alt_id, user_name_full,
-                                      first_name, middle_name, last_name,
-                                      user_profile, user_cat1,
-                                      user_cat2, major, user_cat3,
-                                      department, phone1, main_street,
-                                      main_city, main_state, main_zip,
-                                      email1, userdata)"""
-        )
-        print('\tClearing SQLite3 Table: ILL_ADD')
-        self.sqlite3_cursor.execute("""delete from ILL_ADD""")
-        print('\tGetting Users to be added to ILLiad')
-        user_list = self.sqlite3_cursor.execute(
-            """select * from (SELECT DISTINCT user_id
-                                                     FROM USERS_NEW
-                                                     WHERE user_id Not IN
-                                                    (SELECT DISTINCT user_id
-                                                    FROM USERS_OLD)) f
-                                    join USERS_NEW using(USER_ID)"""
-        ).fetchall()
-        print('\tMarking ' + str(len(user_list)) +
-              ' Users in SQLite3 to be added to ILLiad')
+    def update_old_digests(self, alt_ids):
+        """This function recomputes the DIGEST_OLD digests of Users
+        changed in USERS_OLD
+
+        Parameters:
+        alt_ids: List of the UserNames changed
+
+        Returns:
+        None
+        """
         self.sqlite3_cursor.executemany(
-                """insert into ILL_ADD values(?, ?, ?, ?, ?, ?, ?, ?, ?,?, ?,
-                      ?, ?, ?, ?, ?, ?, ?, ?)""", user_list
-            )
+            """insert or replace into DIGEST_OLD select alt_id,
+            user_digest(""" + _digest_columns() + """)
+            from USERS_OLD where alt_id = ?""",
+            [(i,) for i in alt_ids])
 
-    def gen_user_removals(self):
-        """This creates a table containg entries to be removed in ILLiad
-        These entries are calculated by finding entries present in USERS_OLD
-        that are not present in USERS_NEW.
+    def end_snapshot(self, load):
+        """This function completes a snapshot refresh started by
+        begin_snapshot and stores the new high-water mark
 
         Parameters:
-        None
+        load: The dictionary returned by begin_snapshot
 
         Returns:
         None
         """
+        if load["mark"] is None:
+            print("\tInserted " + str(load["users"]) +
+                  " Users into SQLite3 Table USERS_OLD")
+            self.end_load("USERS_OLD", load["swap"])
+            self.update_digests("USERS_OLD", load["swap"])
+        else:
+            print("\tUpdated " + str(load["users"]) +
+                  " Users in SQLite3 Table USERS_OLD")
+            self.sqlite3_cursor.execute(
+                """delete from USERS_OLD where not exists
+                   (select 1 from temp.ILL_KEYS k
+                    where k.UserName = USERS_OLD.alt_id)""")
+            print("\tRemoved " + str(self.sqlite3_cursor.rowcount) +
+                  " Users deleted from ILLiad from SQLite3 Table USERS_OLD")
+            self.sqlite3_cursor.execute(
+                """delete from DIGEST_OLD where not exists
+                   (select 1 from USERS_OLD u
+                    where u.alt_id = DIGEST_OLD.alt_id)""")
 
-        self.sqlite3_cursor.execute(
-            """create table if not exists
-                           ILL_REMOVE (user_id, alt_id, user_name_full,
-                                      first_name, middle_name, last_name,
-                                      user_profile, user_cat1,
-                                      user_cat2, major, user_cat3,
-                                      department, phone1, main_street,
-                                      main_city, main_state, main_zip,
-                                      email1, userdata)"""
-        )
-        print('\tClearing SQLite3 Table: ILL_REMOVE')
-        self.sqlite3_cursor.execute("""delete from ILL_REMOVE""")
-        print('\tGetting Users to be Removed from ILLiad')
-        user_list = self.sqlite3_cursor.execute(
-            """select * from (SELECT DISTINCT user_id
-                                                     FROM USERS_OLD
-                                                     WHERE user_id Not IN
-                                                    (SELECT DISTINCT user_id
-                                                    FROM USERS_NEW)) f
-                                    join USERS_OLD using(USER_ID)"""
-        ).fetchall()
-        print('\tMarking ' + str(len(user_list)) +
-              ' Users in SQLite3 to be Removed from ILLiad')
-        self.sqlite3_cursor.executemany(
-                """insert into ILL_REMOVE values(?, ?, ?, ?, ?, ?, ?, ?, ?,?,
-                      ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                user_list,
-            )
+        if load["new_mark"] is not None:
+            self.set_state("users_last_changed",
+                           _format_mark(load["new_mark"]))
 
-    def gen_user_updates(self):
-        """This function creates a table containg metadata updates
-        for existing users in ILLiad
+    def get_state(self, name):
+        """This function reads a value from SNAPSHOT_STATE
+
+        Parameters:
+        name: Name of the value
+
+        Returns:
+        value: A string object, None if the value was never set
+        """
+        row = self.sqlite3_cursor.execute(
+            """select value from SNAPSHOT_STATE where name = ?""",
+            (name,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_state(self, name, value):
+        """This function stores a value in SNAPSHOT_STATE
 
         Parameters:
+        name: Name of the value
+        value: A string object
+
+        Returns:
         None
+        """
+        self.sqlite3_cursor.execute(
+            """insert or replace into SNAPSHOT_STATE values (?, ?)""",
+            (name, value))
+
+    def source_fingerprint(self, path):
+        """This function fingerprints a source file and compares it with
+           the fingerprint saved by the previous successful run
+
+        Parameters:
+        path: Path of the source file
+
+        Returns:
+        fingerprint: A (size, mtime, digest, rows_digest) tuple, rows_digest
+            is the saved digest of the Users parsed from path, or None
+        changed: True if the content of path differs from the saved
+            fingerprint or there is none
+        """
+        previous = self.sqlite3_cursor.execute(
+            """select size, mtime, digest, rows_digest
+               from SOURCE_FINGERPRINTS where path = ?""",
+            (path,)).fetchone()
+        size, mtime, digest = file_fingerprint(path, previous)
+        if previous is None:
+            return (size, mtime, digest, None), True
+        return (size, mtime, digest, previous[3]), digest != previous[2]
+
+    def save_fingerprints(self, fingerprints):
+        """This function saves source file fingerprints once a run has
+           succeeded, later runs compare against them
+
+        Parameters:
+        fingerprints: A dictionary mapping paths to the tuples returned by
+            source_fingerprint
 
         Returns:
         None
         """
+        self.sqlite3_cursor.executemany(
+            """insert or replace into SOURCE_FINGERPRINTS
+               values (?, ?, ?, ?, ?)""",
+            [(path,) + tuple(fingerprint)
+             for path, fingerprint in fingerprints.items()])
+        self.sqlite3cnxn.commit()
+
+    @run_metrics.instrumented
+    def cache_users(self, source, source_digest, user_list,
+                    batch_size=BATCH_SIZE):
+        """This function replaces the cached Users of a source file,
+           the cache is only valid for the content identified by
+           source_digest, see cache_digest
+
+        Parameters:
+        source: Path of the source file the Users were parsed from
+        source_digest: A bytes object identifying the content the Users
+            were parsed from
+        user_list: List or iterable containing parsed User data
+        batch_size: Number of Users inserted per executemany
 
+        Returns:
+        count: Number of Users cached
+        rows_digest: A 16 byte bytes object identifying the cached Users
+        """
+        # Invalidated first, a partly written cache is never reused
         self.sqlite3_cursor.execute(
-            """create table if not exists
-                           ILL_UPDATE (user_id, alt_id, user_name_full,
-                                      first_name, middle_name, last_name,
-                                      user_profile, user_cat1,
-                                      user_cat2, major, user_cat3,
-                                      department, phone1, main_street,
-                                      main_city, main_state, main_zip,
-                                      email1, userdata)"""
-        )
-        print('\tClearing SQLite3 Table: ILL_UPDATE')
-        self.sqlite3_cursor.execute("""delete from ILL_UPDATE""")
-        print('\tGetting Users to Updated in ILLiad')
-        user_list = self.sqlite3_cursor.execute(
-            """
-            select f.alt_id, f.last_name, f.first_name,
-            f.user_id, f.user_profile, f.email1, f.phone1, f.department,
-            f.main_street, f.main_city, f.main_state, f.main_zip,
-            f.user_cat1 from (select alt_id, last_name, first_name,
-            user_id, user_profile, email1, phone1, department,
-            SUBSTR(main_street,1,39) as main_street,
-            SUBSTR(main_city, 1, 29) as main_city,
-            SUBSTR(main_state,1,2) as main_state,
-            main_zip, user_cat1,  (IFNULL(alt_id,'')|| IFNULL(last_name,'')
-            || IFNULL(first_name,'')|| IFNULL(user_id,'') || IFNULL(user_profile,'') || IFNULL(email1,'') ||
-            IFNULL(phone1,'')|| IFNULL(department,'')|| IFNULL(SUBSTR(main_street,1,39),'')||
-            IFNULL(SUBSTR(main_city, 1, 29),'') || IFNULL(SUBSTR(main_state,1,2),'')
-            || IFNULL(main_zip,'') || IFNULL(user_cat1,''))
-                as hash from USERS_OLD) as a
-                join (select user_id, last_name, first_name,
-                user_id, user_profile, email1, phone1, department,
-                SUBSTR(main_street,1,39) as main_street,
-            SUBSTR(main_city, 1, 29) as main_city,
-            SUBSTR(main_state,1,2) as main_state,
-            main_zip, user_cat1, alt_id, (IFNULL(alt_id,'')|| IFNULL(last_name,'')
-            || IFNULL(first_name,'')|| IFNULL(user_id,'') || IFNULL(user_profile,'') || IFNULL(email1,'') ||
-            IFNULL(phone1,'')|| IFNULL(department,'')|| IFNULL(SUBSTR(main_street,1,39),'')||
-            IFNULL(SUBSTR(main_city, 1, 29),'') || IFNULL(SUBSTR(main_state,1,2),'')
-            || IFNULL(main_zip,'') || IFNULL(user_cat1,''))
-                as hash
-                from USERS_NEW) f
-                using(alt_id)
-                where f.hash != a.hash"""
-        ).fetchall()
-        print('\tMarking ' + str(len(user_list)) +
-              ' Users in SQLite3 to be Updated in ILLiad')
-        self.sqlite3_cursor.executemany(
-                """insert into ILL_UPDATE(alt_id, last_name, first_name,
-                user_id, user_profile, email1, phone1, department, main_street,
-                main_city, main_state, main_zip, user_cat1)
-                values(?, ?, ?, ?, ?, ?, ?, ?, ?,?, ?, ?, ?)""",
-                user_list,
-            )
+            """delete from USERS_CACHE_SOURCES where source = ?""",
+            (source,))
+        self.sqlite3_cursor.execute(
+            """delete from USERS_CACHE where source = ?""", (source,))
+        digest = hashlib.blake2b(digest_size=16)
+        count = 0
+        for batch in chunked(user_list, batch_size):
+            rows = [user_row(User) for User in batch]
+            for row in rows:
+                digest.update("\x1f".join(
+                    "" if value is None else str(value)
+                    for value in row).encode("utf-8") + b"\x1e")
+            self.sqlite3_cursor.executemany(
+                """insert into USERS_CACHE values(?, ?, ?, ?, ?, ?, ?, ?, ?,
+                ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                [(source,) + tuple(row) for row in rows])
+            count += len(batch)
+        self.sqlite3_cursor.execute(
+            """insert into USERS_CACHE_SOURCES values (?, ?)""",
+            (source, source_digest))
+        self.sqlite3cnxn.commit()
+        return count, digest.digest()
 
-    def update_tables(self, user_list):
-        """This function updates two User management update_tables,
-        USERS_OLD contains the imported users from the previous
-        USERS_NEW contains the new users that are being imported
+    def cache_digest(self, source):
+        """This function returns the digest of the content the cached
+           Users of a source file were parsed from
 
         Parameters:
-        user_list: List containing parsed User data to be passed into SQLite3
+        source: Path of the source file
+
+        Returns:
+        source_digest: The bytes object passed to cache_users,
+            None if the Users of source are not cached
+        """
+        row = self.sqlite3_cursor.execute(
+            """select digest from USERS_CACHE_SOURCES where source = ?""",
+            (source,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def cached_users(self, source):
+        """This function yields the cached Users of a source file in the
+           order they were parsed, the rows are read lazily
+
+        Parameters:
+        source: Path of the source file the Users were parsed from
+
+        Returns:
+        A generator yielding formatted User entries
+        """
+        cursor = self.sqlite3cnxn.cursor()
+        cursor.execute(
+            "select " + ", ".join(USER_COLUMNS) +
+            " from USERS_CACHE where source = ? order by rowid", (source,))
+        for User in cursor:
+            yield User
+
+    def record_run(self, record):
+        """This function keeps a run record in RUN_HISTORY for trending
+
+        Parameters:
+        record: A dictionary as returned by run_metrics.RunMetrics.record
 
         Returns:
         None
         """
-        # Create USERS_OLD table if it doesn't exist,
-        # typically during first run
         self.sqlite3_cursor.execute(
-            """create table if not exists
-                           USERS_OLD (user_id, alt_id, user_name_full,
-                                      first_name, middle_name, last_name,
-                                      user_profile, user_cat1,
-                                      user_cat2, major, user_cat3,
-                                      department, phone1, main_street,
-                                      main_city, main_state, main_zip,
-                                      email1, userdata)"""
-        )
-
-        # Create USERS_NEW table if it doesn't exist,
-        # typically during first run
+            """insert into RUN_HISTORY (started, status, wall_seconds, record)
+               values (?, ?, ?, ?)""",
+            (record["started"], record["status"], record["wall_seconds"],
+             json.dumps(record)))
+        self.sqlite3cnxn.commit()
+
+    def begin_load(self, name, swap=False):
+        """This function prepares a local SQLite3 table to be reloaded,
+        either by clearing it or by creating an empty staging table
+        without secondary indexes next to it
+
+        Parameters:
+        name: Name of a table in SCHEMA
+        swap: Create a staging table instead of clearing name
+
+        Returns:
+        target: Name of the table to insert the new rows into
+        """
+        if not swap:
+            print("\tClearing SQLite3 Table: " + name)
+            self.sqlite3_cursor.execute("delete from " + name)
+            return name
+
+        target = name + "_STAGE"
+        print("\tStaging SQLite3 Table: " + name)
         self.sqlite3_cursor.execute(
-            """create table if not exists
-                           USERS_NEW (user_id, alt_id, user_name_full,
-                                      first_name, middle_name, last_name,
-                                      user_profile, user_cat1,
-                                      user_cat2, major, user_cat3,
-                                      department, phone1, main_street,
-                                      main_city, main_state, main_zip,
-                                      email1, userdata)"""
-        )
-
-        print("\tClearing SQLite3 Table: USERS_OLD")
-        self.sqlite3_cursor.execute("""delete from USERS_OLD""").fetchall()
-
-        print("\tGetting Current ILLiad Users")
-        ill_users = self.ill_cursor.execute("""SELECT UserName, LastName,
-                FirstName, SSN, Status, EMailAddress, Phone, Department,
-                Address, City, State, Zip, Site from Users""").fetchall()
+            "drop table if exists " + self.schema_of(name) + "." + target)
+        self.create_table(name, target)
+        return target
 
-        print("\tInserting " + str(len(ill_users)) +
-              " Users into SQLite3 Table USERS_OLD")
-        self.sqlite3_cursor.executemany("""insert into USERS_OLD
-        (alt_id, last_name, first_name, user_id,
-            user_profile, email1, phone1, department,
-            main_street, main_city, main_state,
-            main_zip, user_cat1)
-            values(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", ill_users)
+    def end_load(self, name, swap=False):
+        """This function completes a reload started by begin_load,
+        a staging table atomically replaces the table it was staged for
+        and the secondary indexes are built after the bulk load
 
-        # # Clear out USERS_NEW and import new users from user_list
-        print("\tClearing SQLite3 Table: USERS_NEW")
-        self.sqlite3_cursor.execute("""DELETE from USERS_NEW""")
-        print("\tInserting " + str(len(user_list)) +
-              " Users into SQLite3 Table USERS_NEW")
-        self.sqlite3_cursor.executemany(
-                        """insert into USERS_NEW values(?, ?, ?, ?, ?, ?, ?, ?,
-                        ?,?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                        user_list,
-                    )
+        Parameters:
+        name: Name of a table in SCHEMA
+        swap: Swap the staging table into place
+
+        Returns:
+        None
+        """
+        if not swap:
+            return
+
+        print("\tSwapping staged SQLite3 Table into " + name)
+        schema = self.schema_of(name)
+        self.sqlite3cnxn.commit()
+        self.sqlite3_cursor.execute("""begin""")
+        try:
+            self.sqlite3_cursor.execute(
+                "drop table " + schema + "." + name)
+            self.sqlite3_cursor.execute(
+                "alter table " + schema + "." + name + "_STAGE rename to " +
+                name)
+            self.create_indexes(name)
+        except BaseException:
+            self.sqlite3cnxn.rollback()
+            raise
+        self.sqlite3cnxn.commit()
+
+    @run_metrics.instrumented
+    def update_digests(self, table, swap=False):
+        """This function recomputes the digests of the DIGEST_COLUMNS
+        for every User in USERS_OLD or USERS_NEW, gen_user_updates
+        compares these instead of the full rows.
+        DIGEST_OLD is keyed by alt_id,
+        DIGEST_NEW is keyed by the rowid in USERS_NEW
+
+        Parameters:
+        table: USERS_OLD or USERS_NEW
+        swap: Reload the digest table through a staging table
+
+        Returns:
+        None
+        """
+        columns = _digest_columns()
+        print("\tComputing User digests for SQLite3 Table " + table)
+        if table == "USERS_OLD":
+            target = self.begin_load("DIGEST_OLD", swap)
+            self.sqlite3_cursor.execute(
+                """insert into """ + target + """ select alt_id,
+                user_digest(""" + columns + """) from USERS_OLD""")
+            self.end_load("DIGEST_OLD", swap)
+        else:
+            target = self.begin_load("DIGEST_NEW", swap)
+            self.sqlite3_cursor.execute(
+                """insert into """ + target + """ select rowid, alt_id,
+                user_digest(""" + columns + """) from USERS_NEW""")
+            self.end_load("DIGEST_NEW", swap)
 
+    @run_metrics.instrumented
     def add_users(self):
         """This function performs User additions to the ILLiad database
            by querying the local SQLite3 ILL_ADD table
+           Existing ILLiad Users are found through the USERS_OLD snapshot,
+           so update_tables must have run first.
+           Rows already recorded in APPLY_LEDGER are skipped.
 
         Parameters:
         None
@@ -283,79 +1906,75 @@ class illiad_manager:
         None
         """
 
-        user_adds = self.sqlite3_cursor.execute(
-            """select alt_id, last_name, first_name, user_id, user_profile,
-            email1, phone1, department, SUBSTR(main_street,1,39),
-            SUBSTR(main_city, 1, 29), SUBSTR(main_state,1,2),
-            main_zip, user_cat1 from ILL_ADD"""
-        ).fetchall()
+        count, user_adds, add_chunk, added_chunk, key = \
+            self.pending_changes("add")
+        print('\tAdding ' + str(count) + ' Users to ILLiad')
+        self.apply_chunks("add", user_adds, add_chunk, added_chunk, key)
 
-        ill_users = self.ill_cursor.execute("""select distinct
-                                            UserName from users""").fetchall()
-        ill_list = []
-        for i in ill_users:
-            ill_list.append(i[0])
+    def add_chunk(self, cursor, add_list):
+        """This function adds a chunk of Users to the ILLiad database
 
-        add_list = []
-        add_id = []
-        for i in user_adds:
-            if i[0] not in ill_list:
-                add_list.append(i)
-                add_id.append(i[0])
+        Parameters:
+        cursor: Cursor object for ILLiad Database
+        add_list: List of ILLiad Users rows, UserName first
 
-        print('\tAdding ' + str(len(add_list)) + ' Users to ILLiad')
+        Returns:
+        add_list: The rows added, passed on to added_chunk
+        """
 
-        if len(add_list) > 0:
-            self.ill_cursor.executemany(
-                    """insert into users (UserName, LastName, FirstName, SSN,
-                    Status, EMailAddress, Phone, Department, Address, City,
-                    State, Zip, Site) values
-                    (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", add_list
-                )
+        add_id = [i[0] for i in add_list]
+        # ILLiad defaults are set by the insert itself. Users already in
+        # ILLiad are skipped, a chunk committed to ILLiad but not to
+        # APPLY_LEDGER is sent again by --resume
+        cursor.executemany(
+                """insert into users (UserName, LastName, FirstName, SSN,
+                Status, EMailAddress, Phone, Department, Address, City,
+                State, Zip, Site, LastChangedDate, NVTGC, Cleared, Web,
+                NotificationMethod, AuthType)
+                select ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, GETDATE(), 'ILL',
+                'Yes', 'Yes', 'Electronic', 'RemoteAuth'
+                where not exists (select 1 from users where UserName = ?)""",
+                [tuple(i) + (i[0],) for i in add_list]
+            )
+        notifications = [(User, activity) for User in add_id
+                         for activity in NOTIFICATION_ACTIVITIES]
+        try:
+            cursor.executemany(NOTIFICATION_INSERT, notifications)
+        except pyodbc.IntegrityError:
+            # Retry per User so only Users with existing
+            # notifications are skipped
             for User in add_id:
-                self.ill_cursor.execute("""update users
-            Set LastChangedDate=GETDATE(), NVTGC='ILL', Cleared='Yes',
-            Web='Yes',NotificationMethod='Electronic', AuthType='RemoteAuth'
-            where UserName = ?
-        """, User)
                 try:
-                    self.ill_cursor.execute("""INSERT INTO UserNotifications
-                                    (UserName, ActivityType, NotificationType)
-                                    VALUES
-                                    (?,'ClearedUser','Email')""", User)
-                    self.ill_cursor.execute("""INSERT INTO UserNotifications
-                                    (UserName, ActivityType, NotificationType)
-                                    VALUES
-                                    (?,'PasswordReset','Email')""", User)
-                    self.ill_cursor.execute("""INSERT INTO UserNotifications
-                                    (UserName, ActivityType, NotificationType)
-                                    VALUES
-                                    (?,'RequestPickup','Email')""", User)
-                    self.ill_cursor.execute("""INSERT INTO UserNotifications
-                                    (UserName, ActivityType, NotificationType)
-                                    VALUES
-                                    (?,'RequestShipped','Email')""", User)
-                    self.ill_cursor.execute("""INSERT INTO UserNotifications
-                            (UserName, ActivityType, NotificationType)
-                            VALUES
-                            (?,'RequestElectronicDelivery','Email')""", User)
-                    self.ill_cursor.execute("""INSERT INTO UserNotifications
-                                    (UserName, ActivityType, NotificationType)
-                                    VALUES
-                                    (?,'RequestOverdue','Email')""", User)
-                    self.ill_cursor.execute("""INSERT INTO UserNotifications
-                                    (UserName, ActivityType, NotificationType)
-                                    VALUES
-                                    (?,'RequestCancelled','Email')""", User)
-                    self.ill_cursor.execute("""INSERT INTO UserNotifications
-                                    (UserName, ActivityType, NotificationType)
-                                    VALUES (?,'RequestOther','Email')""", User)
+                    cursor.executemany(
+                        NOTIFICATION_INSERT,
+                        [(User, activity)
+                         for activity in NOTIFICATION_ACTIVITIES])
                 except pyodbc.IntegrityError:
                     print("Already Exists.")
+        return add_list
 
+    def added_chunk(self, result):
+        """This function keeps the snapshot used by plan_changes in line
+           with ILLiad once a chunk of additions is committed
+
+        Parameters:
+        result: The value returned by add_chunk
+
+        Returns:
+        None
+        """
+
+        # The first row of an alt_id is the one added to ILLiad
+        self.sqlite3_cursor.executemany(
+             "insert or ignore into USERS_OLD " + USERS_OLD_INSERT,
+             [_canonical_ill_user(i) for i in result])
+        self.update_old_digests(set(i[0] for i in result))
+
+    @run_metrics.instrumented
     def remove_users(self):
         """This function performs User removals to the ILLiad database
            by querying the local SQLite3 ILL_REMOVE table
+           Rows already recorded in APPLY_LEDGER are skipped.
 
         Parameters:
         None
@@ -364,33 +1983,100 @@ class illiad_manager:
         None
         """
 
-        user_removals = self.sqlite3_cursor.execute(
-            """select alt_id from ILL_REMOVE"""
-        ).fetchall()
+        count, user_removals, remove_chunk, removed_chunk, key = \
+            self.pending_changes("remove")
+        print('\tRemoving ' + str(count) + ' users from ILLiad')
+        results = self.apply_chunks("remove", user_removals, remove_chunk,
+                                    removed_chunk, key)
+        usertrans = sum(len(protected) for protected, deletable in results)
+        print("\tUsers not deleted due to transaction history: " +
+              str(usertrans))
+
+    def remove_chunk(self, cursor, user_removals):
+        """This function removes a chunk of Users from the ILLiad database,
+           Users with a transaction history are kept
+
+        Parameters:
+        cursor: Cursor object for ILLiad Database
+        user_removals: List of rows containing a UserName
+
+        Returns:
+        protected: A list containing the UserNames kept
+        deletable: A list containing the UserNames removed
+        """
 
-        print('\tRemoving ' + str(len(user_removals)) + ' users from ILLiad')
-        usertrans = 0
-        if len(user_removals) > 0:
-            for idp in user_removals:
-                hasTrans = self.ill_cursor.execute(
-                    """select distinct UserName from users
-                    where UserName=? AND UserName IN
-                    (select UserName from Transactions); """, idp).fetchall()
-                usertrans += len(hasTrans)
-            self.ill_cursor.executemany(
+        holders = self.transaction_holders([i[0] for i in user_removals],
+                                           cursor)
+        protected = []
+        deletable = []
+        for i in user_removals:
+            if i[0] in holders:
+                protected.append(i[0])
+            else:
+                deletable.append((i[0],))
+        if len(deletable) > 0:
+            # The correlated check is a single index seek per row and
+            # guards against transactions placed since the lookup
+            cursor.executemany(
                  """delete from users where UserName=? AND
-                    UserName NOT IN
-                    (select UserName from Transactions); """, user_removals)
-            self.ill_cursor.executemany(
+                    NOT EXISTS (select 1 from Transactions t
+                                where t.UserName = users.UserName)""",
+                 deletable)
+            cursor.executemany(
                  """delete from UserNotifications where UserName=? AND
-                    UserName NOT IN
-                    (select UserName from Transactions); """, user_removals)
-        print("\tUsers not deleted due to transaction history: " +
-              str(usertrans))
+                    NOT EXISTS (select 1 from Transactions t
+                    where t.UserName = UserNotifications.UserName)""",
+                 deletable)
+        return protected, deletable
+
+    def removed_chunk(self, result):
+        """This function keeps the snapshot used by add_users in line
+           with ILLiad once a chunk of removals is committed
+
+        Parameters:
+        result: The value returned by remove_chunk
+
+        Returns:
+        None
+        """
+
+        protected, deletable = result
+        self.sqlite3_cursor.executemany(
+             """delete from USERS_OLD where alt_id=?""", deletable)
+        self.sqlite3_cursor.executemany(
+             """delete from DIGEST_OLD where alt_id=?""", deletable)
+
+    def transaction_holders(self, user_names, cursor=None):
+        """This function looks up which ILLiad Users have a
+           transaction history, these Users must not be removed
+
+        Parameters:
+        user_names: List of UserNames to check
+        cursor: Cursor object for ILLiad Database, defaults to ill_cursor
+
+        Returns:
+        holders: A set containing the UserNames present in ILLiad
+            that have at least one transaction
+        """
 
+        cursor = cursor or self.ill_cursor
+        holders = set()
+        for chunk in chunked(set(user_names), IN_LIST_SIZE):
+            placeholders = ", ".join("?" * len(chunk))
+            rows = cursor.execute(
+                """select distinct u.UserName from users u
+                   where u.UserName IN (""" + placeholders + """) AND
+                   EXISTS (select 1 from Transactions t
+                           where t.UserName = u.UserName)""",
+                chunk).fetchall()
+            holders.update(i[0] for i in rows)
+        return holders
+
+    @run_metrics.instrumented
     def update_users(self):
         """This function performs updates to the ILLiad database by querying
            the local SQLite3 ILL_UPDATE table
+           Rows already recorded in APPLY_LEDGER are skipped.
 
         Parameters:
         None
@@ -399,33 +2085,433 @@ class illiad_manager:
         None
         """
 
-        user_updates = self.sqlite3_cursor.execute(
-            """select last_name
-                    , first_name
-                    , user_id
-                    , user_profile
-                    , email1
-                    , phone1
-                    , department
-                    , SUBSTR(main_street,1,39)
-                    , SUBSTR(main_city, 1, 29)
-                    , SUBSTR(main_state,1,2)
-                    , CASE WHEN length(main_zip)>10 THEN "-ERR-" ELSE main_zip END
-                    , user_cat1
-                    , alt_id
-                 from ILL_UPDATE"""
-        ).fetchall()
+        count, user_updates, update_chunk, updated_chunk, key = \
+            self.pending_changes("update")
+        print('\tUpdating ' + str(count) + ' users in ILLiad')
+        self.apply_chunks("update", user_updates, update_chunk,
+                          updated_chunk, key)
+
+    def update_chunk(self, cursor, user_updates):
+        """This function updates a chunk of Users in the ILLiad database,
+        only the fields recorded in changed_fields are written, with one
+        executemany per set of changed fields
+
+        Parameters:
+        cursor: Cursor object for ILLiad Database
+        user_updates: List of ILLiad Users rows, changed_fields first and
+            UserName last
+
+        Returns:
+        user_updates: The rows applied, passed on to updated_chunk
+        """
 
-        print('\tUpdating ' + str(len(user_updates)) + ' users in ILLiad')
-        if len(user_updates) > 0:
-            self.ill_cursor.executemany(
-                    """update users
-                    set LastName=?, FirstName=?, SSN=?, Status=?,
-                    EMailAddress=?, Phone=?, Department=?, Address=?, City=?,
-                    State=?, Zip=?, Site=?, LastChangedDate=GETDATE(),
-                    AuthType='RemoteAuth'
+        # Users updated more than once always share the full signature,
+        # so their rows stay in order
+        for signature, rows in group_updates(user_updates):
+            cursor.executemany(
+                    """update users set """ +
+                    "".join(UPDATE_FIELDS[i] + "=?, " for i in signature) +
+                    """LastChangedDate=GETDATE(), AuthType='RemoteAuth'
                     where UserName = ?""",
-                    user_updates)
+                    [[row[i] for i in signature] + [row[-1]] for row in rows])
+        return user_updates
+
+    def updated_chunk(self, result):
+        """This function keeps the snapshot used by plan_changes in line
+           with ILLiad once a chunk of updates is committed, only the
+           fields written to ILLiad are changed
+
+        Parameters:
+        result: The value returned by update_chunk or update_chunk_staged
+
+        Returns:
+        None
+        """
+
+        for signature, rows in group_updates(result):
+            self.sqlite3_cursor.executemany(
+                    """update USERS_OLD set """ +
+                    ", ".join(DIGEST_COLUMNS[1:][i] + "=?"
+                              for i in signature) +
+                    """ where alt_id = ?""",
+                    [[row[i] for i in signature] + [row[-1]] for row in rows])
+        self.update_old_digests(set(i[-1] for i in result))
+
+    def update_chunk_staged(self, cursor, user_updates):
+        """This function updates a chunk of Users in the ILLiad database
+        with one set-based statement per set of changed fields. The rows
+        are bulk loaded into the session temp table #ILL_UPDATE, created
+        with the column types of the ILLiad Users table, and joined against
+        Users on UserName.
+
+        Parameters:
+        cursor: Cursor object for ILLiad Database
+        user_updates: List of ILLiad Users rows, changed_fields first and
+            UserName last
+
+        Returns:
+        user_updates: The rows applied, passed on to updated_chunk
+        """
+
+        # Executed without parameters so the temp table outlives the batch
+        cursor.execute(
+                """if object_id('tempdb..#ILL_UPDATE') is null
+                select top 0 LastName, FirstName, SSN, Status,
+                EMailAddress, Phone, Department, Address, City, State,
+                Zip, Site, UserName, cast(null as int) as Signature
+                into #ILL_UPDATE from Users""")
+        cursor.execute("""truncate table #ILL_UPDATE""")
+        # Later rows win, as with one UPDATE per row
+        staged = collections.OrderedDict()
+        groups = group_updates(user_updates)
+        for group, (signature, rows) in enumerate(groups):
+            for i in rows:
+                staged[i[-1]] = tuple(i) + (group,)
+        cursor.executemany(
+                """insert into #ILL_UPDATE (LastName, FirstName, SSN,
+                Status, EMailAddress, Phone, Department, Address, City,
+                State, Zip, Site, UserName, Signature)
+                values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                list(staged.values()))
+        for group, (signature, rows) in enumerate(groups):
+            cursor.execute(
+                    """update u set """ +
+                    "".join(UPDATE_FIELDS[i] + "=s." + UPDATE_FIELDS[i] + ", "
+                            for i in signature) +
+                    """LastChangedDate=GETDATE(), AuthType='RemoteAuth'
+                    from Users u join #ILL_UPDATE s
+                    on s.UserName = u.UserName
+                    where s.Signature = ?""", group)
+        return user_updates
+
+    def pending_changes(self, phase):
+        """This function looks up the pending rows of a phase and the
+        functions applying them, shared by add_users, remove_users,
+        update_users and apply_pipelined
+
+        Parameters:
+        phase: Name of the phase in APPLY_LEDGER, add, update or remove
+
+        Returns:
+        count, rows: As returned by pending_rows
+        apply_chunk, applied_chunk, key: As passed on to apply_chunks
+        """
+
+        if phase == "add":
+            # USERS_OLD holds the ILLiad UserName snapshot taken by
+            # update_tables, Users already present in ILLiad are skipped
+            count, rows = self.pending_rows(
+                """select rowid, alt_id, last_name, first_name, user_id,
+                user_profile, email1, phone1, department, main_street,
+                main_city, main_state, main_zip, user_cat1 from ILL_ADD a
+                where not exists (select 1 from USERS_OLD o
+                                  where o.alt_id = a.alt_id)
+                and not exists (select 1 from APPLY_LEDGER l
+                                where l.phase = 'add' and l.row_id = a.rowid)
+                order by rowid""")
+            return count, rows, self.add_chunk, self.added_chunk, 1
+        if phase == "remove":
+            count, rows = self.pending_rows(
+                """select rowid, alt_id from ILL_REMOVE r
+                where not exists (select 1 from APPLY_LEDGER l
+                                  where l.phase = 'remove'
+                                  and l.row_id = r.rowid)
+                order by rowid""")
+            return count, rows, self.remove_chunk, self.removed_chunk, 1
+        if phase == "update":
+            count, rows = self.pending_rows(
+                """select rowid
+                        , changed_fields
+                        , last_name
+                        , first_name
+                        , user_id
+                        , user_profile
+                        , email1
+                        , phone1
+                        , department
+                        , main_street
+                        , main_city
+                        , main_state
+                        , main_zip
+                        , user_cat1
+                        , alt_id
+                     from ILL_UPDATE u
+                     where not exists (select 1 from APPLY_LEDGER l
+                                       where l.phase = 'update'
+                                       and l.row_id = u.rowid)
+                     order by rowid""")
+            if self.update_backend == "staged":
+                return (count, rows, self.update_chunk_staged,
+                        self.updated_chunk, -1)
+            return count, rows, self.update_chunk, self.updated_chunk, -1
+        raise KeyError(phase)
+
+    def pending_rows(self, query):
+        """This function counts and streams the rows of an ILL_* query,
+        the rows are fetched fetch_size at a time on a cursor of their own
+        while apply_chunks writes APPLY_LEDGER
+
+        Parameters:
+        query: select statement returning the ILL_* rowid first
+
+        Returns:
+        count: Number of rows returned by query
+        rows: A generator yielding the rows of query
+        """
+        count = self.sqlite3_cursor.execute(
+            "select count(*) from (" + query + ")").fetchone()[0]
+        cursor = self.metrics.cursor(self.sqlite3cnxn.cursor(), "sqlite")
+        cursor.execute(query)
+        return count, itertools.chain.from_iterable(
+            fetch_chunks(cursor, self.fetch_size))
+
+    def apply_chunks(self, phase, rows, apply_chunk, applied_chunk=None,
+                     key=1):
+        """This function applies pending rows of an ILL_* table to ILLiad
+        in chunks of apply_batch_size rows. Every chunk runs in its own
+        ILLiad transaction, once it is committed the rowids of its rows are
+        recorded in APPLY_LEDGER and committed to SQLite3, so a failed run
+        can be resumed from the last committed chunk.
+        With apply_workers above 1 the rows are partitioned by UserName and
+        the partitions are applied concurrently on pooled connections,
+        the rows of a UserName are always applied in order by one worker.
+
+        Parameters:
+        phase: Name of the phase in APPLY_LEDGER, add, update or remove
+        rows: List or iterable of rows, the ILL_* rowid first followed by
+            the values passed on to apply_chunk, iterables are consumed
+            one chunk at a time
+        apply_chunk: Function called with an ILLiad cursor and the values
+            of a chunk of rows
+        applied_chunk: Optional function called with the result of
+            apply_chunk once the chunk is committed
+        key: Index of the UserName within a row
+
+        Returns:
+        results: A list containing the result of apply_chunk per chunk
+        """
+
+        results = []
+        if self.apply_workers == 1:
+            for chunk in chunked(rows, self.apply_batch_size):
+                result = self.apply_transaction(self.illcnxn, self.ill_cursor,
+                                                apply_chunk, chunk)
+                self.record_chunk(phase, chunk, result, applied_chunk)
+                results.append(result)
+            return results
+
+        partitions = [[] for _ in range(self.apply_workers)]
+        for row in rows:
+            partition = zlib.crc32(str(row[key]).encode("utf-8"))
+            partitions[partition % self.apply_workers].append(row)
+        partitions = [i for i in partitions if len(i) > 0]
+
+        # SQLite3 is only used from this thread, workers hand committed
+        # chunks back through a queue and a None once they are done
+        committed = queue.Queue()
+        failed = threading.Event()
+
+        def apply_partition(partition):
+            try:
+                for chunk in chunked(partition, self.apply_batch_size):
+                    if failed.is_set():
+                        return
+                    cnxn = self.ill_pool.acquire()
+                    try:
+                        result = self.apply_transaction(
+                            cnxn, self.metrics.cursor(cnxn.cursor(), "illiad"),
+                            apply_chunk, chunk)
+                    finally:
+                        self.ill_pool.release(cnxn)
+                    committed.put((chunk, result))
+            except BaseException:
+                failed.set()
+                raise
+            finally:
+                committed.put(None)
+
+        with concurrent.futures.ThreadPoolExecutor(
+                self.apply_workers) as executor:
+            futures = [executor.submit(apply_partition, i)
+                       for i in partitions]
+            running = len(futures)
+            try:
+                while running > 0:
+                    item = committed.get()
+                    if item is None:
+                        running -= 1
+                        continue
+                    chunk, result = item
+                    self.record_chunk(phase, chunk, result, applied_chunk)
+                    results.append(result)
+            except BaseException:
+                failed.set()
+                raise
+        for future in futures:
+            future.result()
+        return results
+
+    @run_metrics.instrumented
+    def apply_pipelined(self, phases=("add", "update"),
+                        queue_size=PIPELINE_QUEUE_SIZE):
+        """This function applies several phases to ILLiad at the same time,
+        each on a thread and pooled connection of its own. This thread
+        streams the pending rows of every phase in chunks of
+        apply_batch_size into a queue of at most queue_size chunks per
+        phase and records committed chunks in APPLY_LEDGER as they arrive.
+        The phases must change disjoint Users, additions and updates do,
+        removals change USERS_OLD which additions are checked against.
+
+        Parameters:
+        phases: Names of the phases in APPLY_LEDGER
+        queue_size: Maximum number of chunks waiting per phase
+
+        Returns:
+        results: A dictionary of phase name to the list of results of
+            apply_chunk per chunk
+        """
+
+        results = dict((phase, []) for phase in phases)
+        applied = {}
+        feeds = []
+        for phase in phases:
+            count, rows, apply_chunk, applied_chunk, key = \
+                self.pending_changes(phase)
+            print('\tApplying ' + str(count) + ' pending ' + phase +
+                  ' rows to ILLiad')
+            applied[phase] = applied_chunk
+            feeds.append((phase, chunked(rows, self.apply_batch_size),
+                          queue.Queue(queue_size), apply_chunk))
+
+        # Workers drain their queue up to the None sent by this thread,
+        # after a failure without applying, so a put never blocks forever
+        committed = queue.Queue()
+        failed = threading.Event()
+
+        def apply_phase(phase, pending, apply_chunk):
+            try:
+                for chunk in iter(pending.get, None):
+                    if failed.is_set():
+                        continue
+                    cnxn = self.ill_pool.acquire()
+                    try:
+                        result = self.apply_transaction(
+                            cnxn, self.metrics.cursor(cnxn.cursor(), "illiad"),
+                            apply_chunk, chunk)
+                    finally:
+                        self.ill_pool.release(cnxn)
+                    committed.put((phase, chunk, result))
+            except BaseException:
+                # Also reached when no connection could be opened
+                failed.set()
+                for _ in iter(pending.get, None):
+                    pass
+                raise
+            finally:
+                committed.put(None)
+
+        def record(item):
+            phase, chunk, result = item
+            self.record_chunk(phase, chunk, result, applied[phase])
+            results[phase].append(result)
+
+        with concurrent.futures.ThreadPoolExecutor(len(feeds)) as executor:
+            futures = [executor.submit(apply_phase, phase, pending,
+                                       apply_chunk)
+                       for phase, chunks, pending, apply_chunk in feeds]
+            running = len(futures)
+            feeding = list(feeds)
+            try:
+                while len(feeding) > 0:
+                    for feed in list(feeding):
+                        chunk = None if failed.is_set() else next(feed[1],
+                                                                  None)
+                        feed[2].put(chunk)
+                        if chunk is None:
+                            feeding.remove(feed)
+                    while True:
+                        try:
+                            item = committed.get_nowait()
+                        except queue.Empty:
+                            break
+                        if item is None:
+                            running -= 1
+                        else:
+                            record(item)
+                while running > 0:
+                    item = committed.get()
+                    if item is None:
+                        running -= 1
+                    else:
+                        record(item)
+            except BaseException:
+                failed.set()
+                for feed in feeding:
+                    feed[2].put(None)
+                raise
+        for future in futures:
+            future.result()
+        return results
+
+    def apply_transaction(self, cnxn, cursor, apply_chunk, chunk):
+        """This function applies one chunk of rows to ILLiad in a single
+           transaction, rolled back when apply_chunk fails
+
+        Parameters:
+        cnxn: ILLiad Database Connection in autocommit mode
+        cursor: Cursor object of cnxn
+        apply_chunk: Function called with cursor and the chunk values
+        chunk: List of rows, the ILL_* rowid first
+
+        Returns:
+        result: The value returned by apply_chunk
+        """
+
+        cursor.fast_executemany = True
+        cnxn.autocommit = False
+        try:
+            result = apply_chunk(cursor, [i[1:] for i in chunk])
+            cnxn.commit()
+        except BaseException:
+            cnxn.rollback()
+            raise
+        finally:
+            cnxn.autocommit = True
+        return result
+
+    def record_chunk(self, phase, chunk, result, applied_chunk=None):
+        """This function records a committed chunk in APPLY_LEDGER
+
+        Parameters:
+        phase: Name of the phase in APPLY_LEDGER, add, update or remove
+        chunk: List of rows, the ILL_* rowid first
+        result: The value returned by apply_chunk
+        applied_chunk: Optional function called with result
+
+        Returns:
+        None
+        """
+
+        if applied_chunk is not None:
+            applied_chunk(result)
+        self.sqlite3_cursor.executemany(
+            """insert or ignore into APPLY_LEDGER values (?, ?)""",
+            [(phase, i[0]) for i in chunk])
+        self.sqlite3cnxn.commit()
+
+    def reset_ledger(self, phase):
+        """This function forgets which rows of a phase were applied,
+           called whenever its ILL_* table is regenerated
+
+        Parameters:
+        phase: Name of the phase in APPLY_LEDGER, add, update or remove
+
+        Returns:
+        None
+        """
+
+        self.sqlite3_cursor.execute(
+            """delete from APPLY_LEDGER where phase = ?""", (phase,))
 
     def finder(self, tree, elmkey):
         """A XML helper function that returns the text of an Element
@@ -556,10 +2642,44 @@ class illiad_manager:
         new_user.append(longline.join(new_user))
         return new_user
 
+    def iter_users(self, path, cat2dict={}, cat3dict={}):
+        """Stream a XML export and yield formatted User entries one at a time
+        Each <user> element is parsed with UserExtractor and then discarded,
+        so memory use does not grow with the size of the export
+
+        Parameters:
+        path: Path of the XML document to parse
+        cat2dict: A dictionary containing departmental categories
+        cat3dict: A dictionary containing major/degree categories
+
+        Returns:
+        A generator yielding UserRecords containing parsed users fields
+        """
+        extract = UserExtractor(cat2dict, cat3dict)
+        root = None
+        depth = 0
+        for event, elem in ElementTree.iterparse(path,
+                                                 events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+
+            depth -= 1
+            # Only direct children of the root element are User entries
+            if depth == 1:
+                if elem.tag == "user":
+                    yield extract(elem)
+                root.clear()
+
     def close_cnxn(self):
         """Commit transactions and close database
         """
-        self.illcnxn.commit()
+        if self._illcnxn is not None:
+            self._illcnxn.commit()
         self.sqlite3cnxn.commit()
         self.sqlite3cnxn.close()
-        self.illcnxn.close()
+        self.ill_pool.close()
+        if self._illcnxn is not None:
+            self._illcnxn.close()
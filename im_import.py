@@ -1,5 +1,10 @@
+import argparse
+import datetime
+import itertools
 import illiad_manager
 import json
+import os
+import run_metrics
 import xml.etree.ElementTree as ElementTree
 
 """
@@ -34,19 +39,177 @@ cat2s
 cat3s
     - A text file containing degree/major pipe-delimeted metadata
 
+Options:
+
+--stream
+    - Parse the XML documents incrementally and load Users into SQLite3
+      in batches instead of holding both documents in memory
+--batch-size
+    - Number of Users loaded into SQLite3 per batch
+--workers
+    - Number of processes parsing the XML documents, both documents are
+      split into chunks of Users and parsed concurrently when above 1
+--parse-chunk-size
+    - Number of Users handed to a parsing process at once
+--table-swap
+    - Load USERS_OLD and USERS_NEW into fresh staging tables and swap them
+      into place, instead of deleting and reinserting every row
+--incremental
+    - Refresh the local snapshot of ILLiad Users with only the Users
+      changed since the previous run, falls back to a full refresh when
+      there is no previous snapshot
+--full-refresh
+    - Force a full refresh of the local snapshot even with --incremental
+--apply-batch-size
+    - Number of Users applied to ILLiad per transaction
+--fetch-size
+    - Number of rows fetched at once when streaming the ILLiad Users and
+      the pending changes, bounds the memory used by those result sets
+--update-backend
+    - executemany sends one UPDATE per User, staged bulk loads the updates
+      into a temp table on the ILLiad server and applies them with a
+      single UPDATE ... FROM per chunk
+--apply-workers
+    - Number of partitions of the pending changes applied to ILLiad
+      concurrently, Users are partitioned by UserName
+--apply-connections
+    - Maximum number of ILLiad connections used by the apply workers,
+      defaults to --apply-workers
+--skip-unchanged
+    - Fingerprint lib_emp.txt, lib_stu.txt, cat2s and cat3s and skip the
+      import when none changed since the previous successful run, only
+      changed files are parsed and the Users of the others are reused
+--run-record
+    - Path of the JSON run record with the wall time, CPU time, rows
+      read/written, ILLiad round trips and peak RSS of every phase,
+      im_run.json by default, replaced on every run including failed ones
+--run-history
+    - Also keep the run record in the SQLite3 RUN_HISTORY table
+--profile
+    - Profile the parse, diff and apply phases with cProfile into
+      im_profile_parse.prof, im_profile_diff.prof and im_profile_apply.prof,
+      also enabled by setting the IM_PROFILE environment variable.
+      With --stream, --workers or --pipeline Users are parsed while
+      USERS_NEW is loaded, their parsing is part of the diff profile
+--diff-engine
+    - sql generates the ILL_* tables with one SQLite3 query each,
+      python classifies every User in a single pass over USERS_NEW
+--plan-only [PATH]
+    - Parse the XML documents and compare them with the ILLiad snapshot
+      cached in sqlite.db, then write a manifest of the Users that would be
+      added, updated and removed to PATH, im_plan.json by default.
+      ILLiad is not contacted and the pending ILL_* tables are kept.
+      Applied changes are written back to the snapshot chunk by chunk
+--resume
+    - Skip parsing and comparison and continue applying the pending
+      additions and updates of a previous run that failed
+--pipeline
+    - Overlap the stages of the import: the ILLiad Users are downloaded on
+      a connection of their own while the XML documents are parsed and
+      loaded, and additions and updates are applied to ILLiad at the same
+      time on two connections. Every stage hands chunks to the next through
+      a bounded queue, so memory stays capped. Parsing is streamed as with
+      --stream, --apply-workers partitioning is not used
+--sqlite-profile
+    - SQLite3 connection profile, one of default, wal, fast or memory,
+      memory stages USERS_NEW and DIGEST_NEW in memory and keeps the
+      tables that persist between runs in sqlite.db, the ILLiad snapshot
+      in USERS_OLD and DIGEST_OLD included, so a full refresh still
+      rewrites the snapshot on disk, see --incremental
+
 """
 
+# Source files parsed into Users, in import order
+USER_FILES = ("lib_emp.txt", "lib_stu.txt")
+
+# Category files used while parsing the USER_FILES
+CATEGORY_FILES = ("cat2s", "cat3s")
+
+
+def parse_args(argv=None):
+    """Parse the command line options of this module
 
-def main():
+    Parameters:
+    argv: List of command line arguments, defaults to sys.argv
+
+    Returns:
+    args: argparse Namespace containing the parsed options
     """
-    This function does initial loading of files,
-    it steps line-by-line through two XML files to generate SQLite3 Tables
+    parser = argparse.ArgumentParser(
+        description="Synchronize ILLiad users with the XML user exports")
+    parser.add_argument("--stream", action="store_true",
+                        help="parse the XML documents incrementally")
+    parser.add_argument("--batch-size", type=int,
+                        default=illiad_manager.BATCH_SIZE,
+                        help="number of Users loaded into SQLite3 per batch")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes parsing the XML documents")
+    parser.add_argument("--parse-chunk-size", type=int,
+                        default=illiad_manager.PARSE_CHUNK_SIZE,
+                        help="number of Users handed to a parsing process")
+    parser.add_argument("--table-swap", action="store_true",
+                        help="load SQLite3 tables through swapped staging "
+                        "tables")
+    parser.add_argument("--incremental", action="store_true",
+                        help="refresh only ILLiad Users changed since the "
+                        "previous run")
+    parser.add_argument("--full-refresh", action="store_true",
+                        help="force a full refresh of the ILLiad snapshot")
+    parser.add_argument("--apply-batch-size", type=int,
+                        default=illiad_manager.APPLY_BATCH_SIZE,
+                        help="number of Users applied to ILLiad per "
+                        "transaction")
+    parser.add_argument("--fetch-size", type=int,
+                        default=illiad_manager.FETCH_SIZE,
+                        help="number of rows fetched at once when streaming "
+                        "result sets")
+    parser.add_argument("--update-backend", default="executemany",
+                        choices=illiad_manager.UPDATE_BACKENDS,
+                        help="how updates are applied to ILLiad")
+    parser.add_argument("--apply-workers", type=int,
+                        default=illiad_manager.APPLY_WORKERS,
+                        help="number of partitions applied to ILLiad "
+                        "concurrently")
+    parser.add_argument("--apply-connections", type=int,
+                        help="maximum number of ILLiad connections used by "
+                        "the apply workers")
+    parser.add_argument("--skip-unchanged", action="store_true",
+                        help="skip the import when the source files are "
+                        "unchanged")
+    parser.add_argument("--run-record", default="im_run.json",
+                        help="path of the JSON run record")
+    parser.add_argument("--run-history", action="store_true",
+                        help="keep the run record in SQLite3")
+    parser.add_argument("--profile", action="store_true",
+                        default=os.environ.get("IM_PROFILE", "") not in
+                        ("", "0"),
+                        help="profile the parse, diff and apply phases")
+    parser.add_argument("--diff-engine", default="sql",
+                        choices=illiad_manager.DIFF_ENGINES,
+                        help="how the ILL_* tables are generated")
+    parser.add_argument("--plan-only", nargs="?", const="im_plan.json",
+                        metavar="PATH",
+                        help="write a manifest of the pending changes "
+                        "without contacting ILLiad")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue applying the changes of a failed run")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="overlap downloading, parsing, loading and "
+                        "applying")
+    parser.add_argument("--sqlite-profile", default="default",
+                        choices=sorted(illiad_manager.SQLITE_PROFILES),
+                        help="SQLite3 connection profile")
+    return parser.parse_args(argv)
+
+
+def load_categories():
+    """Load the departmental and degree/major category files
 
     Parameters:
     None
 
     Returns:
-    None
+    cat2dict, cat3dict: Two dictionaries mapping category codes to names
     """
     cat2dict = {}
     cat3dict = {}
@@ -59,37 +222,277 @@ def main():
         for cat3 in cat3file:
             cat3data = cat3.split("|")
             cat3dict[cat3data[2]] = cat3data[3]
+    return cat2dict, cat3dict
+
+
+def parse_file(args, im, path, cat2dict, cat3dict):
+    """Parse a single XML document into formatted User entries
+
+    Parameters:
+    args: argparse Namespace containing the parsed options
+    im: illiad_manager object
+    path: Path of the XML document
+    cat2dict: A dictionary containing departmental categories
+    cat3dict: A dictionary containing major/degree categories
+
+    Returns:
+    user_list: A list, or with --stream, --workers and --pipeline a lazily
+        consumed iterable, containing formatted User entries
+    """
+    if args.workers > 1:
+        return illiad_manager.parse_parallel(
+            [path], cat2dict, cat3dict, args.workers, args.parse_chunk_size)
+    if args.stream or args.pipeline:
+        return im.iter_users(path, cat2dict, cat3dict)
+
+    extract = illiad_manager.UserExtractor(cat2dict, cat3dict)
+    root = ElementTree.parse(path).getroot()
+    return [extract(i) for i in root.findall("user")]
+
+
+def parse_users(args, im, cat2dict, cat3dict):
+    """Parse both XML documents into formatted User entries
+
+    Parameters:
+    args: argparse Namespace containing the parsed options
+    im: illiad_manager object
+    cat2dict: A dictionary containing departmental categories
+    cat3dict: A dictionary containing major/degree categories
+
+    Returns:
+    user_list: A list, or with --stream, --workers and --pipeline a lazily
+        consumed iterable, containing formatted User entries
+    """
+    if args.workers > 1:
+        # Parsed Users are merged in file order while update_tables loads them
+        return illiad_manager.parse_parallel(
+            list(USER_FILES), cat2dict, cat3dict,
+            args.workers, args.parse_chunk_size)
+    if args.stream or args.pipeline:
+        # Users are parsed lazily while update_tables loads them
+        return itertools.chain.from_iterable(
+            parse_file(args, im, path, cat2dict, cat3dict)
+            for path in USER_FILES)
 
-    empdoc = ElementTree.parse("lib_emp.txt")
-    studoc = ElementTree.parse("lib_stu.txt")
-    emproot = empdoc.getroot()
-    sturoot = studoc.getroot()
     user_list = []
-    im = illiad_manager.illiad_manager()
-    for i in emproot.findall("user"):
-        user_list.append(im.getuser(i, cat2dict, cat3dict))
+    for path in USER_FILES:
+        user_list.extend(parse_file(args, im, path, cat2dict, cat3dict))
+    return user_list
+
+
+def parse_changed_users(args, im):
+    """Parse only the XML documents changed since the previous successful
+    run, the Users of unchanged documents are read from the cache.
+    A changed category file changes the Users of every document.
+    The cache of a failed run can hold Users of other content, it is only
+    reused when it was parsed from the current documents and categories.
+
+    Parameters:
+    args: argparse Namespace containing the parsed options
+    im: illiad_manager object
+
+    Returns:
+    user_list: An iterable containing formatted User entries,
+        None when the Users are unchanged
+    fingerprints: A dictionary of source file fingerprints, saved
+        with im.save_fingerprints once the run succeeded
+    """
+    fingerprints = {}
+    categories_changed = False
+    for path in CATEGORY_FILES:
+        fingerprints[path], changed = im.source_fingerprint(path)
+        categories_changed = categories_changed or changed
+    changed_files = []
+    for path in USER_FILES:
+        fingerprints[path], changed = im.source_fingerprint(path)
+        if changed or categories_changed:
+            changed_files.append(path)
+    if len(changed_files) == 0:
+        return None, fingerprints
+
+    categories = b"".join(fingerprints[path][2] for path in CATEGORY_FILES)
+    cat2dict, cat3dict = load_categories()
+    users_changed = False
+    for path in USER_FILES:
+        source_digest = fingerprints[path][2] + categories
+        if path in changed_files:
+            print('\tParsing Changed File ' + path)
+        elif im.cache_digest(path) != source_digest:
+            print('\tParsing Uncached File ' + path)
+        else:
+            continue
+        count, rows_digest = im.cache_users(
+            path, source_digest,
+            parse_file(args, im, path, cat2dict, cat3dict), args.batch_size)
+        size, mtime, digest, previous = fingerprints[path]
+        fingerprints[path] = (size, mtime, digest, rows_digest)
+        users_changed = users_changed or rows_digest != previous
+    if not users_changed:
+        return None, fingerprints
+    return (itertools.chain.from_iterable(
+                im.cached_users(path) for path in USER_FILES),
+            fingerprints)
+
+
+def apply_changes(im, pipelined=False):
+    """Apply the pending User changes to ILLiad
+
+    Parameters:
+    im: illiad_manager object
+    pipelined: Apply additions and updates at the same time
+
+    Returns:
+    None
+    """
+    # print('Removing Users')
+    # im.remove_users()
+    if pipelined:
+        print('Adding and Updating Users')
+        im.apply_pipelined(("add", "update"))
+        return
+    print('Adding Users')
+    im.add_users()
+    print('Updating Users')
+    im.update_users()
+
+
+def plan_changes(args, im):
+    """Parse the XML documents and write a manifest of the changes the
+    next run would apply against the cached ILLiad snapshot, without
+    touching ILLiad or the pending ILL_* tables
+
+    Parameters:
+    args: argparse Namespace containing the parsed options
+    im: illiad_manager object
+
+    Returns:
+    None
+    """
+    cat2dict, cat3dict = load_categories()
+    user_list = parse_users(args, im, cat2dict, cat3dict)
+    print('Loading Parsed Users')
+    im.load_new_users(user_list, args.batch_size, args.table_swap)
+    print('Planning Changes')
+    plan = im.plan_changes()
+    plan["created"] = datetime.datetime.now().isoformat()
+    for name in ("adds", "updates", "removals"):
+        print('\t' + str(plan[name]["users"]) + ' ' + name + ' in ' +
+              str(plan[name]["transactions"]) + ' transactions')
+    with open(args.plan_only, "w") as plan_file:
+        json.dump(plan, plan_file, indent=2)
+    print('Wrote Plan ' + args.plan_only)
+
+
+def finish_run(args, im, status):
+    """Write the run record, and keep it in RUN_HISTORY with --run-history,
+    before the connections are closed
+
+    Parameters:
+    args: argparse Namespace containing the parsed options
+    im: illiad_manager object
+    status: Outcome of the run, SUCCESS, FAILURE or SKIPPED
+
+    Returns:
+    None
+    """
+    record = im.metrics.write(args.run_record, status)
+    if args.run_history:
+        im.record_run(record)
+
+
+def main(argv=None):
+    """
+    This function does initial loading of files,
+    it steps line-by-line through two XML files to generate SQLite3 Tables
+
+    Parameters:
+    argv: List of command line arguments, defaults to sys.argv
+
+    Returns:
+    None
+    """
+    args = parse_args(argv)
+    # The record of a previous run must never be mailed as this run's,
+    # every run below writes a new one, FAILURE included
+    if os.path.exists(args.run_record):
+        os.remove(args.run_record)
+    apply_connections = args.apply_connections
+    if args.pipeline and apply_connections is None:
+        # One connection per stage running against ILLiad at once
+        apply_connections = max(2, args.apply_workers)
+    try:
+        im = illiad_manager.illiad_manager(
+            args.sqlite_profile, apply_batch_size=args.apply_batch_size,
+            update_backend=args.update_backend,
+            apply_workers=args.apply_workers,
+            apply_connections=apply_connections, fetch_size=args.fetch_size)
+    except Exception as e:
+        print("FAILURE: ", e)
+        run_metrics.RunMetrics().write(args.run_record, "FAILURE")
+        return
+    if args.resume:
+        try:
+            print('Resuming Pending Changes')
+            with run_metrics.phase_profile("apply", args.profile):
+                apply_changes(im, args.pipeline)
+            finish_run(args, im, "SUCCESS")
+            print('Closing Connection')
+            im.close_cnxn()
+        except Exception as e:
+            print("FAILURE: ", e)
+            finish_run(args, im, "FAILURE")
+        return
+
+    if args.plan_only:
+        try:
+            plan_changes(args, im)
+            finish_run(args, im, "SUCCESS")
+            im.close_cnxn()
+        except Exception as e:
+            print("FAILURE: ", e)
+            finish_run(args, im, "FAILURE")
+        return
 
-    for i in sturoot.findall("user"):
-        user_list.append(im.getuser(i, cat2dict, cat3dict))
+    fingerprints = None
     try:
-        print('Updating Tables')
-        im.update_tables(user_list)
-        print('Generating User Adds')
-        im.gen_user_adds()
-        # print('Generating User Removes')
-        # im.gen_user_removals()
-        print('Generating User Updates')
-        im.gen_user_updates()
-        # print('Removing Users')
-        # im.remove_users()
-        print('Adding Users')
-        im.add_users()
-        print('Updating Users')
-        im.update_users()
+        with im.metrics.phase("parse"), \
+                run_metrics.phase_profile("parse", args.profile):
+            if args.skip_unchanged:
+                user_list, fingerprints = parse_changed_users(args, im)
+            else:
+                cat2dict, cat3dict = load_categories()
+                user_list = parse_users(args, im, cat2dict, cat3dict)
+        if args.skip_unchanged and user_list is None:
+            print('Source Files Unchanged, Skipping Import')
+            im.save_fingerprints(fingerprints)
+            finish_run(args, im, "SKIPPED")
+            im.close_cnxn()
+            return
+        with run_metrics.phase_profile("diff", args.profile):
+            print('Updating Tables')
+            im.update_tables(user_list, args.batch_size, args.table_swap,
+                             args.incremental and not args.full_refresh,
+                             args.pipeline)
+            if args.diff_engine == "python":
+                print('Generating User Adds and Updates')
+                im.gen_user_changes(removals=False)
+            else:
+                print('Generating User Adds')
+                im.gen_user_adds()
+                # print('Generating User Removes')
+                # im.gen_user_removals()
+                print('Generating User Updates')
+                im.gen_user_updates()
+        with run_metrics.phase_profile("apply", args.profile):
+            apply_changes(im, args.pipeline)
+        if fingerprints is not None:
+            im.save_fingerprints(fingerprints)
+        finish_run(args, im, "SUCCESS")
         print('Closing Connection')
         im.close_cnxn()
     except Exception as e:
         print("FAILURE: ", e)
+        finish_run(args, im, "FAILURE")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,341 @@
+import contextlib
+import cProfile
+import datetime
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+"""
+This module records how long each phase of an ILLiad user import takes and
+how much work it does, so a slow run can be traced to the phase causing it.
+
+The following functions exist:
+
+CountingCursor:
+    - Wraps a pyodbc or SQLite3 cursor and counts statements and rows
+RunMetrics:
+    - Accumulates wall time, CPU time, rows read/written, ODBC round trips
+      and peak RSS per phase and builds the JSON run record
+instrumented:
+    - Decorator recording an illiad_manager method as a phase
+peak_rss_kb:
+    - Peak resident set size of the process
+summary:
+    - Format a run record as plain text, used by sendemail.py
+phase_profile:
+    - Opt-in cProfile capture of a phase, a no-op when disabled
+
+Round trips count the statements sent to ILLiad, an executemany counts
+once with fast_executemany and once per row without it. Phases nest,
+the counts of a phase include the phases it calls.
+"""
+
+# Counters kept per database
+COUNTERS = ("round_trips", "rows_read", "rows_written")
+
+# Databases a CountingCursor can be attributed to
+DATABASES = ("illiad", "sqlite")
+
+
+def peak_rss_kb():
+    """Return the peak resident set size of this process in kilobytes,
+    None where the resource module is unavailable
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # Reported in bytes instead of kilobytes
+        peak = peak // 1024
+    return peak
+
+
+class CountingCursor:
+    """A cursor proxy counting the statements executed and the rows read
+    and written through it, every other attribute is passed through
+    """
+
+    def __init__(self, cursor, metrics, database):
+        """Object defintions:
+              cursor:
+                - The wrapped pyodbc or SQLite3 cursor
+              metrics:
+                - RunMetrics object the counts are added to
+              database:
+                - One of DATABASES
+        """
+        object.__setattr__(self, "_cursor", cursor)
+        object.__setattr__(self, "_metrics", metrics)
+        object.__setattr__(self, "_database", database)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+    def execute(self, sql, *params):
+        self._cursor.execute(sql, *params)
+        rowcount = getattr(self._cursor, "rowcount", -1)
+        self._metrics.count(self._database, round_trips=1,
+                            rows_written=rowcount if rowcount > 0 else 0)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        if not isinstance(seq_of_params, (list, tuple)):
+            seq_of_params = list(seq_of_params)
+        self._cursor.executemany(sql, seq_of_params)
+        if getattr(self._cursor, "fast_executemany", True):
+            round_trips = 1
+        else:
+            round_trips = len(seq_of_params)
+        self._metrics.count(self._database, round_trips=round_trips,
+                            rows_written=len(seq_of_params))
+        return self
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._metrics.count(self._database, rows_read=1)
+        return row
+
+    def fetchmany(self, *size):
+        rows = self._cursor.fetchmany(*size)
+        self._metrics.count(self._database, rows_read=len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._metrics.count(self._database, rows_read=len(rows))
+        return rows
+
+    def __iter__(self):
+        # Counted once the iteration ends, not per row
+        rows = 0
+        try:
+            for row in self._cursor:
+                rows += 1
+                yield row
+        finally:
+            self._metrics.count(self._database, rows_read=rows)
+
+
+class RunMetrics:
+    """Per phase wall time, CPU time, row and round trip counts of a run
+    """
+
+    def __init__(self):
+        """Object defintions:
+              started:
+                - Local time the run started
+              totals:
+                - Dictionary of COUNTERS per database for the whole run
+              phases:
+                - Dictionary of phase name to its accumulated metrics,
+                  in the order the phases first completed
+        """
+        self.started = datetime.datetime.now()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.totals = dict((database, dict.fromkeys(COUNTERS, 0))
+                           for database in DATABASES)
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def cursor(self, cursor, database):
+        """Wrap a cursor so its work is counted
+
+        Parameters:
+        cursor: pyodbc or SQLite3 cursor
+        database: One of DATABASES
+
+        Returns:
+        A CountingCursor object
+        """
+        return CountingCursor(cursor, self, database)
+
+    def count(self, database, **counts):
+        """Add to the counters of a database, safe to call from the
+        apply worker threads
+
+        Parameters:
+        database: One of DATABASES
+        counts: Keyword arguments naming COUNTERS
+
+        Returns:
+        None
+        """
+        with self.lock:
+            totals = self.totals[database]
+            for name, value in counts.items():
+                totals[name] += value
+
+    def snapshot(self):
+        """Return a flat copy of the counters of every database
+        """
+        with self.lock:
+            return dict((database + "_" + name, value)
+                        for database, totals in self.totals.items()
+                        for name, value in totals.items())
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager recording the enclosed code as phase name,
+        repeated phases are accumulated
+
+        Parameters:
+        name: Name of the phase
+
+        Returns:
+        A context manager
+        """
+        before = self.snapshot()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() - start_cpu
+            after = self.snapshot()
+            with self.lock:
+                phase = self.phases.setdefault(
+                    name, dict({"calls": 0, "wall_seconds": 0.0,
+                                "cpu_seconds": 0.0},
+                               **dict.fromkeys(after, 0)))
+                phase["calls"] += 1
+                phase["wall_seconds"] += wall
+                phase["cpu_seconds"] += cpu
+                for key, value in after.items():
+                    phase[key] += value - before[key]
+                phase["peak_rss_kb"] = peak_rss_kb()
+
+    def record(self, status):
+        """Build the JSON serializable run record
+
+        Parameters:
+        status: Outcome of the run, SUCCESS, FAILURE or SKIPPED
+
+        Returns:
+        record: A dictionary describing the run and each of its phases
+        """
+        return {
+            "started": self.started.isoformat(),
+            "finished": datetime.datetime.now().isoformat(),
+            "status": status,
+            "wall_seconds": time.perf_counter() - self.start_wall,
+            "cpu_seconds": time.process_time() - self.start_cpu,
+            "peak_rss_kb": peak_rss_kb(),
+            "totals": self.snapshot(),
+            "phases": [dict(name=name, **phase)
+                       for name, phase in self.phases.items()],
+        }
+
+    def write(self, path, status):
+        """Write the run record to a JSON file
+
+        Parameters:
+        path: Path of the JSON file
+        status: Outcome of the run, SUCCESS, FAILURE or SKIPPED
+
+        Returns:
+        record: The record written
+        """
+        record = self.record(status)
+        with open(path, "w") as run_file:
+            json.dump(record, run_file, indent=2)
+        return record
+
+
+class _NotProfiled:
+    """Context manager doing nothing, returned by phase_profile when
+    profiling is disabled
+    """
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NOT_PROFILED = _NotProfiled()
+
+
+@contextlib.contextmanager
+def _profiled(path):
+    """Profile the enclosed code with cProfile and dump the stats to path
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print("\tWrote Profile " + path)
+
+
+def phase_profile(phase, enabled, directory="."):
+    """Return a context manager profiling a phase of the import into
+    directory/im_profile_<phase>.prof, readable with pstats or snakeviz.
+    Only the calling thread is profiled.
+
+    Parameters:
+    phase: Name of the phase, parse, diff or apply
+    enabled: Profile the phase, otherwise NOT_PROFILED is returned
+    directory: Directory the profile is written to
+
+    Returns:
+    A context manager
+    """
+    if not enabled:
+        return NOT_PROFILED
+    return _profiled(os.path.join(directory, "im_profile_" + phase + ".prof"))
+
+
+def instrumented(method):
+    """Decorator recording each call of an illiad_manager method as a
+    phase of the metrics attribute of the object, if it has one
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        metrics = getattr(self, "metrics", None)
+        if metrics is None:
+            return method(self, *args, **kwargs)
+        with metrics.phase(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def summary(record):
+    """Format a run record as plain text
+
+    Parameters:
+    record: A dictionary as returned by RunMetrics.record
+
+    Returns:
+    A string object with one line per phase
+    """
+    lines = ["Run %s, started %s, %.1f seconds (%.1f CPU), peak RSS %s KB" %
+             (record["status"], record["started"], record["wall_seconds"],
+              record["cpu_seconds"], record["peak_rss_kb"]),
+             "%-20s %6s %9s %9s %11s %11s %11s" %
+             ("phase", "calls", "wall s", "cpu s", "odbc trips",
+              "odbc rows", "sqlite rows")]
+    for phase in record["phases"]:
+        lines.append("%-20s %6d %9.2f %9.2f %11d %11d %11d" % (
+            phase["name"], phase["calls"], phase["wall_seconds"],
+            phase["cpu_seconds"], phase["illiad_round_trips"],
+            phase["illiad_rows_read"] + phase["illiad_rows_written"],
+            phase["sqlite_rows_read"] + phase["sqlite_rows_written"]))
+    return "\n".join(lines) + "\n"
@@ -3,6 +3,8 @@
 import smtplib, ssl
 import secrets
 import email 
+import json
+import run_metrics
 
 # Construct message based on results of ILLiad update
 # If any step failed, status should be failed. 
@@ -15,6 +17,13 @@ with open("im_output.txt", "r") as results:
         else: 
            update_status = "SUCCESS"
         message += row
+
+# Append the per phase summary of the run record written by im_import
+try:
+    with open("im_run.json", "r") as run_file:
+        message += "\n" + run_metrics.summary(json.load(run_file))
+except (OSError, ValueError, KeyError):
+    pass
 msg = email.message.EmailMessage()
 msg['Subject'] = "ILLiad %s User Management - %s" % (secrets.environment, update_status) 
 msg['From'] = secrets.sender
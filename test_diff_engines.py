@@ -0,0 +1,130 @@
+import ast
+import os
+import random
+import sqlite3
+
+import pytest
+
+pyodbc = pytest.importorskip("pyodbc")
+
+import benchmark
+import illiad_manager
+import im_import
+
+"""
+Checks that gen_user_changes produces the same ILL_* tables as the
+SQL queries of gen_user_adds, gen_user_removals and gen_user_updates.
+The synthetic sources of benchmark.py are extended with the cases
+the generator never produces, Users without a user_id, alt_ids
+exported more than once and Users with several changed fields.
+Run with: python -m pytest -q
+
+The following functions exist:
+    add_edge_cases
+    diff_tables
+    test_synthetic_import
+    test_edge_cases
+"""
+
+USERS = 300
+
+
+def add_edge_cases(directory):
+    """Extend the sources written by benchmark.generate_sources
+    with the cases the synthetic generator never produces
+
+    Parameters:
+    directory: Directory holding the sources and illiad.db
+
+    Returns:
+    None
+    """
+    # The same alt_ids exported a second time with other details
+    rng = random.Random(2)
+    path = os.path.join(directory, "lib_stu.txt")
+    with open(path) as export:
+        text = export.read()
+    duplicates = "".join(benchmark.synthetic_user(i, rng) + "\n"
+                         for i in range(5))
+    with open(path, "w") as export:
+        export.write(text.replace("</users>", duplicates + "</users>"))
+
+    cnxn = sqlite3.connect(os.path.join(directory, "illiad.db"))
+    # Users without a user_id, both exported and gone from the exports
+    cnxn.execute("""update Users set SSN = null
+                    where UserName in ('user0000010', 'user0000011',
+                                       'gone0000000', 'gone0000001')""")
+    # Users with several fields changed since the previous import
+    cnxn.execute("""update Users set LastName = 'Old', Phone = '0',
+                    City = 'Old City', Status = 'OLD'
+                    where UserName in ('user0000020', 'user0000021',
+                                       'user0000001')""")
+    cnxn.commit()
+    cnxn.close()
+
+
+def diff_tables(directory, null_user_ids=False):
+    """Load the sources in directory and generate the ILL_* tables
+    with both diff engines
+
+    Parameters:
+    directory: Directory holding the sources and illiad.db
+    null_user_ids: Clear the user_id of some Users in USERS_NEW
+
+    Returns:
+    expected: The ILL_* tables generated by the SQL queries
+    generated: The ILL_* tables generated by gen_user_changes
+    """
+    ill_path = os.path.join(directory, "illiad.db")
+    im = illiad_manager.illiad_manager(
+        sqlite_path=os.path.join(directory, "sqlite.db"),
+        illiad_connect=lambda: benchmark.StandInConnection(ill_path))
+    try:
+        cat2dict, cat3dict = im_import.load_categories()
+        im.update_tables(im_import.parse_users(
+            im_import.parse_args([]), im, cat2dict, cat3dict))
+        if null_user_ids:
+            im.sqlite3_cursor.execute(
+                """update USERS_NEW set user_id = null
+                   where alt_id in ('user0000012', 'user0000030',
+                                    'user0000031')""")
+            im.update_digests("USERS_NEW")
+
+        im.gen_user_adds()
+        im.gen_user_removals()
+        im.gen_user_updates()
+        expected = benchmark._ill_tables(im)
+        im.gen_user_changes()
+        generated = benchmark._ill_tables(im)
+    finally:
+        im.close_cnxn()
+    return expected, generated
+
+
+def test_synthetic_import(tmp_path, monkeypatch):
+    benchmark.generate_sources(str(tmp_path), USERS, churn=0.1)
+    monkeypatch.chdir(tmp_path)
+    expected, generated = diff_tables(str(tmp_path))
+    assert all(expected.values())
+    assert generated == expected
+
+
+def test_edge_cases(tmp_path, monkeypatch):
+    benchmark.generate_sources(str(tmp_path), USERS, churn=0.1)
+    add_edge_cases(str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    expected, generated = diff_tables(str(tmp_path), null_user_ids=True)
+    assert generated == expected
+
+    def rows(table, alt_id):
+        return [i for i in map(ast.literal_eval, expected[table])
+                if i[1] == alt_id]
+
+    # Duplicate alt_ids are updated in full, once per exported row
+    assert [i[-1] for i in rows("ILL_UPDATE", "user0000001")] == [None, None]
+    # Users without a user_id are added, never removed
+    assert [i[0] for i in rows("ILL_ADD", "user0000012")] == [None]
+    assert rows("ILL_REMOVE", "gone0000000") == []
+    # Several changed fields in a single update
+    changed_fields = rows("ILL_UPDATE", "user0000020")[0][-1]
+    assert bin(changed_fields).count("1") > 1
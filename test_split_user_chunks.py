@@ -0,0 +1,58 @@
+import pytest
+
+pyodbc = pytest.importorskip("pyodbc")
+
+import illiad_manager
+
+"""
+Checks that the chunks of split_user_chunks parse into the same Users
+as the serial iter_users, for exports with elements and comments
+before the first <user> entry.
+Run with: python -m pytest -q
+
+The following functions exist:
+    write_export
+    test_split_user_chunks
+"""
+
+USERS = "".join("<user><primary_id>user%d</primary_id>"
+                "<last_name>Last%d</last_name></user>\n" % (i, i)
+                for i in range(5))
+
+EXPORTS = {
+    "plain": "<users>\n" + USERS + "</users>\n",
+    "attributes": '<users total_record_count="5">\n' + USERS + "</users>\n",
+    "count_element": "<users><total_record_count>5</total_record_count>\n" +
+                     USERS + "</users>\n",
+    "commented_tag": "<users><!-- <note> -->\n" + USERS + "</users>\n",
+    "commented_user": "<!-- <user>user9</user> --><users>\n"
+                      "<!-- <user><primary_id>user9</primary_id></user> -->"
+                      "\n" + USERS + "</users>\n",
+}
+
+
+def write_export(directory, name):
+    """Write one of the EXPORTS as a XML document
+
+    Parameters:
+    directory: pathlib.Path of the directory the document is written to
+    name: Key of the export in EXPORTS
+
+    Returns:
+    path: A string object containing the path of the document
+    """
+    path = directory / (name + ".txt")
+    path.write_text('<?xml version="1.0" encoding="UTF-8"?>\n' +
+                    EXPORTS[name])
+    return str(path)
+
+
+@pytest.mark.parametrize("name", sorted(EXPORTS))
+def test_split_user_chunks(tmp_path, name):
+    path = write_export(tmp_path, name)
+    # iter_users does not use the database connections, skip __init__
+    im = illiad_manager.illiad_manager.__new__(illiad_manager.illiad_manager)
+    expected = list(im.iter_users(path))
+    assert [i.alt_id for i in expected] == ["user%d" % i for i in range(5)]
+    assert list(illiad_manager.parse_parallel(
+        [path], workers=2, chunk_size=2)) == expected